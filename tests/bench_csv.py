@@ -0,0 +1,45 @@
+"""CSV取込のベンチマーク（文字コード判定＋1回読込と以前の総当たり読込、表駆動パーサーと以前のパーサー）
+
+    python tests/bench_csv.py [行数 ...]
+"""
+import io, sys, time
+from helpers import OLD_PARSERS, load_app, read_csv_tryloop, synth_broker_csv
+
+SIZES = [10_000, 100_000]
+ENCODINGS = ['cp932', 'utf-8', 'utf-8-sig']
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(*args); best = min(best, time.perf_counter() - t)
+    return best
+
+def bench_read(app, sizes):
+    parser = app.parse_realized_jp
+    print(f"{'rows':>8} {'encoding':>10} {'MB':>6} {'read_csv_auto':>14} {'tryloop':>10}")
+    for n in sizes:
+        src = synth_broker_csv('realized_jp', n)
+        for enc in ENCODINGS:
+            data = src.to_csv(index=False).encode(enc)
+            new = timed(lambda: app.read_csv_auto(io.BytesIO(data), usecols=app.CSV_USECOLS[parser]))
+            old = timed(lambda: read_csv_tryloop(io.BytesIO(data)))
+            print(f"{n:>8,} {enc:>10} {len(data) / 1e6:>6.1f} {new:>13.3f}s {old:>9.3f}s")
+
+def bench_parse(app, sizes):
+    print(f"{'rows':>8} {'format':>12} {'parse_broker_csv':>17} {'old parser':>11}")
+    for n in sizes:
+        for fmt_name, old_parser in OLD_PARSERS.items():
+            data = synth_broker_csv(fmt_name, n).to_csv(index=False).encode('cp932')
+            df = read_csv_tryloop(io.BytesIO(data))
+            new = timed(app.parse_broker_csv, df, fmt_name)
+            old = timed(old_parser, df)
+            print(f"{n:>8,} {fmt_name:>12} {new:>16.3f}s {old:>10.3f}s")
+
+def main(sizes):
+    app = load_app()
+    bench_read(app, sizes)
+    print()
+    bench_parse(app, sizes)
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or SIZES)
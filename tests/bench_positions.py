@@ -0,0 +1,29 @@
+"""calc_positions のベンチマーク（ベクトル化版と高速化前のループ版）
+
+    python tests/bench_positions.py [件数 ...]
+
+ループ版は LOOP_MAX 件までだけ計測する（100万件では数分かかるため）。
+"""
+import sys, time
+from helpers import load_app, calc_positions_loop, synth_history
+
+SIZES = [10_000, 100_000, 1_000_000]
+LOOP_MAX = 100_000
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(*args); best = min(best, time.perf_counter() - t)
+    return best
+
+def main(sizes):
+    app = load_app()
+    print(f"{'fills':>10} {'vectorized':>12} {'loop':>12} {'speedup':>8}")
+    for n in sizes:
+        h = synth_history(n, tickers=max(300, n // 200))
+        vec = timed(app.calc_positions, h)
+        loop = timed(calc_positions_loop, h, repeat=1) if n <= LOOP_MAX else None
+        print(f"{n:>10,} {vec:>11.3f}s " + (f"{loop:>11.3f}s {loop / vec:>7.1f}x" if loop else f"{'-':>12} {'-':>8}"))
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or SIZES)
@@ -0,0 +1,37 @@
+"""株価取得のベンチマーク（偽プロバイダで1リクエストの往復時間を模す）
+
+    python tests/bench_prices.py [銘柄数 ...]
+
+1銘柄ずつ順に取得していた以前の方式と、PriceService の一括取得・共有キャッシュを比べる。
+"""
+import sys, time
+from concurrent.futures import ThreadPoolExecutor
+from helpers import FakePriceProvider, load_app
+
+SIZES = [10, 40, 100]
+LATENCY = 0.05   # 1リクエストの往復（秒）
+SESSIONS = 8
+
+def main(sizes):
+    app = load_app()
+    print(f"{'symbols':>8} {'serial':>9} {'batched':>9} {f'{SESSIONS} sessions':>12} {'cached':>9}")
+    for n in sizes:
+        symbols = [f'S{i}' for i in range(n)]
+        fake = FakePriceProvider({s: 100.0 for s in symbols}, latency=LATENCY)
+        t = time.perf_counter()
+        for s in symbols: fake.fetch([s])
+        serial = time.perf_counter() - t
+
+        svc = app.PriceService(FakePriceProvider(fake.prices, latency=LATENCY))
+        t = time.perf_counter(); svc.quotes(symbols); batched = time.perf_counter() - t
+
+        svc = app.PriceService(FakePriceProvider(fake.prices, latency=LATENCY))
+        t = time.perf_counter()
+        with ThreadPoolExecutor(SESSIONS) as ex: list(ex.map(lambda _: svc.quotes(symbols), range(SESSIONS)))
+        sessions = time.perf_counter() - t
+
+        t = time.perf_counter(); svc.quotes(symbols); cached = time.perf_counter() - t
+        print(f"{n:>8} {serial:>8.3f}s {batched:>8.3f}s {sessions:>11.3f}s {cached * 1000:>7.2f}ms")
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or SIZES)
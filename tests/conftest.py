@@ -0,0 +1,6 @@
+import pytest
+from helpers import load_app
+
+@pytest.fixture(scope='session')
+def app():
+    return load_app()
@@ -0,0 +1,236 @@
+"""テスト・ベンチマーク共用：アプリの読み込み、高速化前の実装（比較の基準）、合成データと偽の株価プロバイダ"""
+import os, runpy, threading, time, types, logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def load_app():
+    """trade_analyzer_sheets.py を保存先なし（Sheets/SQLite 未設定）で読み込んだ名前空間"""
+    for k in ['GCP_SERVICE_ACCOUNT_JSON', 'SPREADSHEET_ID', 'TRADELOG_BACKEND']:
+        os.environ.pop(k, None)
+    logging.disable(logging.WARNING)
+    try:
+        g = runpy.run_path(str(ROOT / 'trade_analyzer_sheets.py'), run_name='trade_analyzer_sheets')
+    finally:
+        logging.disable(logging.NOTSET)
+    return types.SimpleNamespace(**g)
+
+# ==================== 高速化前の実装 ====================
+def calc_positions_loop(df_hist):
+    """銘柄ごとに1行ずつ移動平均を計算していた保有計算"""
+    if len(df_hist) == 0: return pd.DataFrame()
+    result = []
+    for ticker in df_hist['ticker'].unique():
+        sub = df_hist[df_hist['ticker'] == ticker].sort_values('trade_date', kind='stable')
+        name = sub['name'].iloc[-1]; market = sub['market'].iloc[-1]
+        spot = sub[sub['trade_type'].isin(['現物','現引']) | (sub['market']=='米国株')]
+        spot_qty = spot[spot['action'].isin(['買付','入庫'])]['quantity'].sum() - spot[spot['action']=='売付']['quantity'].sum()
+        kenin = sub[sub['trade_type']=='現引']['quantity'].sum()
+        margin_qty = sub[sub['action']=='買建']['quantity'].sum() - sub[sub['action']=='売埋']['quantity'].sum() - kenin
+        def avg_price(rows, buy_acts, sell_act):
+            qty, avg = 0.0, 0.0
+            for _, r in rows.sort_values('trade_date', kind='stable').iterrows():
+                q = float(r['quantity']); p = float(r['price'])
+                if r['action'] in buy_acts:
+                    avg = (avg*qty + p*q)/(qty+q) if (qty+q)>0 else 0; qty += q
+                elif r['action'] == sell_act:
+                    qty = max(0, qty-q)
+                    if qty == 0: avg = 0
+            return round(avg, 2)
+        if spot_qty > 0:
+            buy_acts = ['買付','入庫'] if market=='日本株' else ['買付']
+            result.append({'ticker':ticker,'name':name,'market':market,'type':'spot',
+                           'quantity':int(spot_qty),'avg_price':avg_price(spot,buy_acts,'売付')})
+        if margin_qty > 0:
+            result.append({'ticker':ticker,'name':name,'market':market,'type':'margin',
+                           'quantity':int(margin_qty),
+                           'avg_price':avg_price(sub[sub['action'].isin(['買建','売埋'])],['買建'],'売埋')})
+    return pd.DataFrame(result) if result else pd.DataFrame()
+
+def read_csv_tryloop(file):
+    """文字コードを順に試しながら全列を読み直していた CSV 読込"""
+    for enc in ['cp932', 'utf-8-sig', 'utf-8', 'shift_jis', 'latin-1']:
+        try:
+            file.seek(0)
+            return pd.read_csv(file, encoding=enc)
+        except: continue
+    file.seek(0)
+    return pd.read_csv(file, encoding='latin-1')
+
+# 行ごとの apply と文字列日付で組み立てていた証券会社CSVパーサー
+def _clean_num_old(s):
+    return pd.to_numeric(
+        s.astype(str).str.replace(',','').str.replace('−','-').str.strip(),
+        errors='coerce'
+    ).fillna(0)
+
+def parse_realized_jp_old(df):
+    df = df.copy(); df.columns = df.columns.str.strip()
+    result = pd.DataFrame({
+        'market': '日本株',
+        'ticker': df['銘柄コード'].astype(str).str.strip().apply(
+            lambda x: str(int(float(x))) if x.replace('.','').isdigit() else x),
+        'name': df['銘柄名'],
+        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
+        'build_date': '',
+        'quantity': _clean_num_old(df['数量[株]']).astype(int),
+        'sell_price': _clean_num_old(df['売却/決済単価[円]']),
+        'avg_cost': _clean_num_old(df['平均取得価額[円]']),
+        'realized_pl': _clean_num_old(df['実現損益[円]']),
+    })
+    if '建約定日' in df.columns:
+        result['build_date'] = pd.to_datetime(df['建約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d')
+    result['realized_pl_pct'] = np.where(
+        result['avg_cost'] > 0,
+        (result['realized_pl'] / (result['avg_cost'] * result['quantity']) * 100).round(2), 0.0)
+    result['hold_days'] = ''
+    return result
+
+def parse_realized_us_old(df):
+    df = df.copy(); df.columns = df.columns.str.strip()
+    result = pd.DataFrame({
+        'market': '米国株',
+        'ticker': df['ティッカーコード'].astype(str).str.strip(),
+        'name': df['銘柄名'],
+        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
+        'build_date': '',
+        'quantity': _clean_num_old(df['数量[株]']).astype(int),
+        'sell_price': _clean_num_old(df['売却/決済単価[USドル]']),
+        'avg_cost': _clean_num_old(df['平均取得価額[円]']),
+        'realized_pl': _clean_num_old(df['実現損益[円]']),
+    })
+    result['realized_pl_pct'] = np.where(
+        result['avg_cost'] > 0,
+        (result['realized_pl'] / result['avg_cost'] / result['quantity'] * 100).round(2), 0.0)
+    result['hold_days'] = ''
+    return result
+
+def parse_history_jp_old(df):
+    df = df.copy(); df.columns = df.columns.str.strip()
+    return pd.DataFrame({
+        'market': '日本株',
+        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
+        'ticker': df['銘柄コード'].astype(str).str.strip().apply(
+            lambda x: str(int(float(x))) if x.replace('.','').isdigit() else x),
+        'name': df['銘柄名'],
+        'trade_type': df['取引区分'],
+        'action': df['売買区分'],
+        'quantity': _clean_num_old(df['数量［株］']).astype(int),
+        'price': _clean_num_old(df['単価［円］']),
+        'build_date': pd.to_datetime(df['建約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d') if '建約定日' in df.columns else '',
+    })
+
+def parse_history_us_old(df):
+    df = df.copy(); df.columns = df.columns.str.strip()
+    return pd.DataFrame({
+        'market': '米国株',
+        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
+        'ticker': df['ティッカー'].astype(str).str.strip(),
+        'name': df['銘柄名'],
+        'trade_type': df['取引区分'],
+        'action': df['売買区分'],
+        'quantity': _clean_num_old(df['数量［株］']).astype(int),
+        'price': _clean_num_old(df['単価［USドル］']),
+        'build_date': '',
+    })
+
+OLD_PARSERS = {'realized_jp': parse_realized_jp_old, 'realized_us': parse_realized_us_old,
+               'history_jp': parse_history_jp_old, 'history_us': parse_history_us_old}
+
+# ==================== 合成データ ====================
+def synth_history(n, tickers=300, days=3000, seed=0):
+    """日米・現物/現引/入庫/信用が混ざった取引履歴（days を小さくすると同日約定が増える）"""
+    rng = np.random.default_rng(seed)
+    t = rng.integers(0, tickers, n)
+    us = t % 5 == 0
+    tick = np.where(us, np.char.add('US', t.astype(str)), (1000 + t).astype(str))
+    typ = np.where(us, '現物', rng.choice(['現物', '信用新規', '信用返済', '現引', '入庫'], n,
+                                         p=[.5, .2, .2, .05, .05])).astype(object)
+    act = np.where(rng.random(n) < .55, '買付', '売付').astype(object)
+    act[typ == '信用新規'] = '買建'
+    act[typ == '信用返済'] = '売埋'
+    act[typ == '入庫'] = '入庫'; typ[typ == '入庫'] = '現物'
+    act[typ == '現引'] = '買付'
+    act[us & (rng.random(n) < .03)] = '入庫'
+    return pd.DataFrame({
+        'market': np.where(us, '米国株', '日本株'),
+        'trade_date': pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, days, n), 'D'),
+        'ticker': tick, 'name': np.char.add('N', tick), 'trade_type': typ, 'action': act,
+        'quantity': rng.integers(1, 10, n) * 100, 'price': np.round(rng.uniform(100, 5000, n), 1),
+        'build_date': ''})
+
+def synth_broker_csv(fmt_name, n, seed=0):
+    """SBI証券風のエクスポート（BROKER_FORMATS の各形式、使わない列も含む文字列の表）"""
+    rng = np.random.default_rng(seed)
+    d = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 2000, n), 'D')
+    day = lambda s: np.asarray(s.strftime('%Y/%m/%d'), dtype=object)
+    num = lambda a, f: [format(x, f) for x in a]
+    codes = rng.integers(1300, 9999, n).astype(str).astype(object)
+    codes[::7] = '130A'; codes[::11] = np.char.add(codes[::11].astype(str), '.0'); codes[::13] = '07203'
+    tickers = rng.choice(['AAPL', 'MSFT', 'NVDA', ' BRK.B '], n)
+    names = np.char.add('銘柄', rng.integers(0, 500, n).astype(str))
+    qty = rng.integers(1, 50, n) * 100
+    if fmt_name.startswith('realized'):
+        build = day(d - pd.to_timedelta(rng.integers(1, 100, n), 'D'))
+        df = pd.DataFrame({
+            '約定日': day(d), '銘柄名': names, '口座': '特定', '信用区分': '-',
+            '数量[株]': num(qty, ','), '平均取得価額[円]': num(rng.uniform(100, 20000, n), ',.1f'),
+            '実現損益[円]': num(rng.integers(-300000, 300000, n), ','), '備考': 'メモ' * 5})
+        if fmt_name == 'realized_jp':
+            df.insert(1, '銘柄コード', codes); df['建約定日'] = build
+            df['売却/決済単価[円]'] = num(rng.uniform(100, 20000, n), ',.1f')
+        else:
+            df.insert(1, 'ティッカーコード', tickers)
+            df['売却/決済単価[USドル]'] = num(rng.uniform(10, 900, n), ',.2f')
+        return df
+    df = pd.DataFrame({
+        '約定日': day(d), '銘柄名': names, '取引区分': rng.choice(['現物', '信用新規', '信用返済', '現引'], n),
+        '売買区分': rng.choice(['買付', '売付', '買建', '売埋'], n), '数量［株］': num(qty, ','),
+        '受渡日': day(d + pd.Timedelta(days=2)), '手数料': '0'})
+    if fmt_name == 'history_jp':
+        df.insert(1, '銘柄コード', codes)
+        df['単価［円］'] = num(rng.uniform(100, 20000, n), ',.1f')
+        df['建約定日'] = np.where(rng.random(n) < .5, '', day(d))
+    else:
+        df.insert(1, 'ティッカー', tickers)
+        df['単価［USドル］'] = num(rng.uniform(10, 900, n), ',.2f')
+    return df
+
+def synth_tradelog_rows(cols, n, seed=0):
+    """シートに書く形（文字列）の Trade_Log 行。タグ・保有日数・納得度は一部空欄"""
+    rng = np.random.default_rng(seed)
+    tl = rng.choice(['', '順張り', '逆張り', 'イベント'], n)
+    raw = pd.DataFrame({c: '' for c in cols}, index=range(n)).assign(
+        id=[f'{i:08x}' for i in range(n)], market=rng.choice(['日本株', '米国株'], n),
+        ticker=rng.integers(1000, 1100, n).astype(str), name=rng.choice(['a', 'b', 'c'], n),
+        trade_date=(pd.Timestamp('2026-10-17') - pd.to_timedelta(rng.integers(0, 1500, n), 'D')).strftime('%Y-%m-%d'),
+        quantity='100', realized_pl=rng.integers(-50000, 50000, n).astype(str),
+        hold_days=np.where(rng.random(n) < .3, '', rng.integers(0, 200, n).astype(str)),
+        tag_large=tl, tag_medium=np.where(tl == '', '', rng.choice(['', '新高値ブレイク', '二番底'], n)),
+        satisfaction=np.where(tl == '', '', rng.integers(1, 6, n).astype(str)))
+    raw.loc[::97, 'realized_pl'] = '0'
+    return raw
+
+# ==================== 偽の株価プロバイダ ====================
+class FakePriceProvider:
+    """yfinance の代わりに使う株価プロバイダ。prices にある銘柄だけ返し、failing は取れない銘柄。
+    1回の fetch に latency 秒かかり、呼ばれた銘柄を calls に記録する"""
+    def __init__(self, prices=None, failing=(), latency=0.0):
+        self.prices = dict(prices or {}); self.failing = set(failing); self.latency = latency
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def fetch(self, symbols):
+        with self._lock: self.calls.append(list(symbols))
+        if self.latency: time.sleep(self.latency)
+        return {s: self.prices[s] for s in symbols if s in self.prices and s not in self.failing}
+
+    def history(self, symbols, start):
+        idx = pd.date_range(start, periods=3, freq='D', name='Date')
+        return {s: pd.DataFrame({c: self.prices[s] for c in ['Open', 'High', 'Low', 'Close', 'Volume']}, index=idx)
+                for s in symbols if s in self.prices and s not in self.failing}
+
+    def earnings(self, symbols, limit=24):
+        return pd.DataFrame({'symbol': [], 'date': pd.DatetimeIndex([])})
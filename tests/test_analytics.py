@@ -0,0 +1,39 @@
+from datetime import date
+import numpy as np
+import pandas as pd
+import pytest
+from helpers import synth_tradelog_rows
+
+def tradelog(app, n, seed=0):
+    return app.sorted_tradelog(f'test-{n}-{seed}', app._normalize_tradelog(synth_tradelog_rows(app.TRADELOG_COLS, n, seed)))
+
+def assert_same(a, b):
+    if isinstance(a, dict):
+        assert a.keys() == b.keys()
+        for k in a: assert_same(a[k], b[k])
+    elif isinstance(a, pd.DataFrame):
+        assert list(a.columns) == list(b.columns) and len(a) == len(b)
+        for c in a.columns: assert_same(a[c], b[c])
+    elif isinstance(a, pd.Series) and pd.api.types.is_numeric_dtype(a) and not isinstance(a.dtype, pd.CategoricalDtype):
+        np.testing.assert_allclose(a.to_numpy(float), b.to_numpy(float), atol=1e-6)
+    elif isinstance(a, pd.Series):
+        assert a.astype(str).tolist() == b.astype(str).tolist()
+    else:
+        assert np.isclose(float(a), float(b))
+
+PERIODS = [(None, None), (date(2025, 10, 18), None), (date(2024, 1, 1), date(2024, 3, 31)), (date(2030, 1, 1), None)]
+
+@pytest.mark.parametrize('n', [0, 1, 50, 3000])
+@pytest.mark.parametrize('start,end', PERIODS)
+def test_sql_cube_matches_pandas(app, n, start, end):
+    if not app.DUCKDB_AVAILABLE: pytest.skip('duckdb なし')
+    df = tradelog(app, n)
+    table = app.tradelog_arrow(f'test-{n}', df)
+    sql = app._finish_cube(*app._cube_sql(table, *app.date_bounds(df, start, end)))
+    assert_same(app._finish_cube(*app._cube_pandas(df, start, end)), sql)
+
+def test_date_bounds_include_end_day(app):
+    df = tradelog(app, 500, seed=1)
+    i, j = app.date_bounds(df, date(2025, 1, 1), date(2025, 1, 31))
+    inside = df['trade_date'].between(pd.Timestamp('2025-01-01'), pd.Timestamp('2025-01-31 23:59'))
+    assert (i, j) == (inside.idxmax(), inside[::-1].idxmax() + 1) and inside.sum() == j - i
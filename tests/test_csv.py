@@ -0,0 +1,63 @@
+import io
+import pandas as pd
+import pytest
+from helpers import OLD_PARSERS, read_csv_tryloop, synth_broker_csv
+
+FORMATS = ['realized_jp', 'realized_us', 'history_jp', 'history_us']
+ENCODINGS = ['cp932', 'utf-8', 'utf-8-sig']
+
+def encode(df, enc):
+    return df.to_csv(index=False).encode(enc)
+
+@pytest.mark.parametrize('enc', ENCODINGS)
+def test_detect_encoding(app, enc):
+    data = encode(synth_broker_csv('history_jp', 200), enc)
+    assert app.detect_encoding(data[:app.CSV_SAMPLE_BYTES]) == enc
+
+def test_detect_encoding_tolerates_character_cut_at_sample_edge(app):
+    data = encode(pd.DataFrame({'銘柄名': ['銘柄'] * 10}), 'utf-8')
+    cut = data.index('銘柄'.encode()) + 1
+    assert app.detect_encoding(data[:cut]) == 'utf-8'
+
+@pytest.mark.parametrize('fmt_name', FORMATS)
+@pytest.mark.parametrize('enc', ENCODINGS)
+def test_read_csv_auto_parses_like_known_encoding(app, enc, fmt_name):
+    # サンプル（256KB）の境界を越える大きさで、使わない列も含む
+    src = synth_broker_csv(fmt_name, 6000, seed=3)
+    data = encode(src, enc)
+    assert len(data) > app.CSV_SAMPLE_BYTES
+    parser = app.CSV_PARSERS[f'parse_{fmt_name}']
+    got = parser(app.read_csv_auto(io.BytesIO(data), usecols=app.CSV_USECOLS[parser]))
+    pd.testing.assert_frame_equal(got, parser(pd.read_csv(io.BytesIO(data), encoding=enc, dtype=str)))
+    # 以前の読込（文字コードを順に試して全列を読む）とも同じ結果
+    pd.testing.assert_frame_equal(got, parser(read_csv_tryloop(io.BytesIO(data))))
+
+def test_read_csv_auto_only_reads_used_columns(app):
+    data = encode(synth_broker_csv('realized_jp', 10), 'cp932')
+    df = app.read_csv_auto(io.BytesIO(data), usecols=app.CSV_USECOLS[app.parse_realized_jp])
+    assert set(df.columns) == set(app.CSV_USECOLS[app.parse_realized_jp])
+
+def as_text_dates(df):
+    """日付列を以前の出力と同じ 'YYYY-MM-DD' 文字列（欠損は空）にそろえる"""
+    df = df.copy()
+    for col in ['trade_date', 'build_date']:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime('%Y-%m-%d')
+        df[col] = df[col].fillna('').astype(str)
+    return df
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('fmt_name', FORMATS)
+def test_parse_broker_csv_matches_old_parsers(app, fmt_name, seed):
+    src = synth_broker_csv(fmt_name, 3000, seed=seed)
+    # 空欄・'-'・全角マイナスの数値、前後空白の混じる列
+    num = [c for c in src.columns if '単価' in c][0]
+    src.loc[::17, num] = '-'; src.loc[::19, num] = ''
+    if '実現損益[円]' in src.columns:
+        src.loc[::23, '実現損益[円]'] = '−1,234'
+    data = encode(src, 'cp932')
+    got = app.parse_broker_csv(pd.read_csv(io.BytesIO(data), encoding='cp932', dtype=str), fmt_name)
+    want = OLD_PARSERS[fmt_name](pd.read_csv(io.BytesIO(data), encoding='cp932'))
+    got, want = as_text_dates(got), as_text_dates(want)
+    assert list(got.columns) == list(want.columns)
+    pd.testing.assert_frame_equal(got, want, check_dtype=False, atol=0.011)
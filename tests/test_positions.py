@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+from helpers import calc_positions_loop, synth_history
+
+def hist(rows):
+    df = pd.DataFrame(rows, columns=['market', 'trade_date', 'ticker', 'name', 'trade_type', 'action', 'quantity', 'price'])
+    return df.assign(trade_date=pd.to_datetime(df['trade_date']), build_date='')
+
+def by_key(pos):
+    return pos.sort_values(['ticker', 'type'], ignore_index=True)
+
+@pytest.mark.parametrize('seed', range(8))
+@pytest.mark.parametrize('n,tickers,days', [(40, 3, 5), (400, 20, 30), (3000, 60, 2000)])
+def test_vectorized_matches_loop(app, seed, n, tickers, days):
+    h = synth_history(n, tickers=tickers, days=days, seed=seed)
+    got, want = app.calc_positions(h), calc_positions_loop(h)
+    if want.empty:
+        assert got.empty; return
+    got, want = by_key(got), by_key(want)
+    assert got[['ticker', 'name', 'market', 'type', 'quantity']].astype(str).equals(
+        want[['ticker', 'name', 'market', 'type', 'quantity']].astype(str))
+    np.testing.assert_allclose(got['avg_price'], want['avg_price'], atol=0.011)
+
+def test_split_application_matches_full(app):
+    h = synth_history(2000, tickers=40, days=200, seed=1).sort_values('trade_date', kind='stable')
+    state = app.empty_position_state()
+    for part in np.array_split(np.arange(len(h)), 5):
+        state = app.apply_fills(state, h.iloc[part])
+    got, want = by_key(app.positions_view(state)), by_key(calc_positions_loop(h))
+    assert got['quantity'].tolist() == want['quantity'].tolist()
+    np.testing.assert_allclose(got['avg_price'], want['avg_price'], atol=0.011)
+
+def test_empty_history(app):
+    assert app.calc_positions(synth_history(0)).empty
+
+JP = hist([
+    ('日本株', '2026-10-01', '7203', 'トヨタ', '現物', '買付', 100, 2500.0),
+    ('日本株', '2026-10-15', '7203', 'トヨタ', '現物', '買付', 100, 2700.0),
+])
+US = hist([
+    ('米国株', '2026-10-10', 'AAPL', 'Apple', '現物', '買付', 10, 230.0),
+])
+
+def test_older_fills_of_another_market_are_applied(app):
+    state, wm = app.apply_history(app.empty_position_state(), JP, None)
+    state, wm = app.apply_history(state, US, wm)
+    pos = app.positions_view(state).set_index('ticker')
+    assert pos.loc['AAPL', 'quantity'] == 10 and pos.loc['AAPL', 'avg_price'] == 230.0
+    assert pos.loc['7203', 'quantity'] == 200
+    assert wm['markets']['日本株']['date'] == '2026-10-15'
+    assert wm['markets']['米国株']['date'] == '2026-10-10'
+
+def test_reimport_applies_nothing_twice(app):
+    state, wm = app.apply_history(app.empty_position_state(), pd.concat([JP, US], ignore_index=True), None)
+    again, wm2 = app.apply_history(state, pd.concat([US, JP], ignore_index=True), wm)
+    pd.testing.assert_frame_equal(app.positions_view(again).sort_values('ticker', ignore_index=True),
+                                  app.positions_view(state).sort_values('ticker', ignore_index=True))
+    assert wm2 == wm
+
+def test_out_of_order_fills_in_same_market_recompute_that_market(app):
+    late = hist([('日本株', '2026-10-15', '7203', 'トヨタ', '現物', '買付', 100, 2700.0)])
+    state, wm = app.apply_history(app.empty_position_state(), pd.concat([late, US], ignore_index=True), None)
+    state, wm = app.apply_history(state, JP, wm)
+    pd.testing.assert_frame_equal(
+        app.positions_view(state).sort_values('ticker', ignore_index=True),
+        app.calc_positions(pd.concat([JP, US], ignore_index=True)).sort_values('ticker', ignore_index=True))
+
+def test_legacy_watermark_only_covers_markets_in_state(app):
+    state = app.apply_fills(app.empty_position_state(), JP)
+    last = JP[JP['trade_date'] == JP['trade_date'].max()]
+    legacy = {'date': '2026-10-15', 'keys': list(app.fill_keys(last))}
+    state, wm = app.apply_history(state, pd.concat([JP, US], ignore_index=True), legacy)
+    pos = app.positions_view(state).set_index('ticker')
+    assert pos.loc['7203', 'quantity'] == 200 and pos.loc['AAPL', 'quantity'] == 10
+    assert set(wm['markets']) == {'日本株', '米国株'}
+
+def test_overlapping_recent_export_applies_only_unapplied_fills(app):
+    h = synth_history(3000, tickers=30, days=120, seed=5).sort_values('trade_date', kind='stable', ignore_index=True)
+    d = h['trade_date']
+    first = h[d <= pd.Timestamp('2018-03-20')]
+    recent = h[d >= pd.Timestamp('2018-03-15')]      # 前回の取込と数日重なる直近分
+    state, wm = app.apply_history(app.empty_position_state(), first, None)
+    state, wm = app.apply_history(state, recent, wm)
+    pd.testing.assert_frame_equal(by_key(app.positions_view(state)), by_key(app.calc_positions(h)))
+
+def test_overlap_keeps_jp_position(app):
+    state, wm = app.apply_history(app.empty_position_state(), JP, None)
+    recent = hist([('日本株', '2026-10-15', '7203', 'トヨタ', '現物', '買付', 100, 2700.0),
+                   ('日本株', '2026-10-16', '7203', 'トヨタ', '現物', '売付', 50, 2800.0)])
+    state, wm = app.apply_history(state, recent, wm)
+    pos = app.positions_view(state).set_index('ticker')
+    assert pos.loc['7203', 'quantity'] == 150 and pos.loc['7203', 'avg_price'] == 2600.0
+
+def test_unapplied_old_fill_without_full_history_is_refused(app):
+    state, wm = app.apply_history(app.empty_position_state(), JP, None)
+    missed = hist([('日本株', '2026-10-05', '9984', 'SBG', '現物', '買付', 100, 9000.0)])
+    with pytest.raises(ValueError):
+        app.apply_history(state, missed, wm)
+
+def test_watermark_keeps_recent_keys_only(app):
+    h = synth_history(2000, tickers=10, days=400, seed=2)
+    _, wm = app.apply_history(app.empty_position_state(), h, None)
+    for w in wm['markets'].values():
+        assert min(w['keys']) >= w['since'] >= w['first']
+        assert pd.Timestamp(w['date']) - pd.Timestamp(w['since']) == pd.Timedelta(days=app.FILL_KEY_DAYS)
@@ -0,0 +1,61 @@
+import threading
+import pytest
+from helpers import FakePriceProvider
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    return now
+
+def test_quotes_are_cached_for_ttl(app, clock):
+    fake = FakePriceProvider({'7203.T': 2500.0, 'AAPL': 230.0})
+    svc = app.PriceService(fake, ttl=60)
+    assert svc.quotes(['7203.T', 'AAPL']) == {'7203.T': 2500.0, 'AAPL': 230.0}
+    fake.prices['AAPL'] = 231.0
+    clock[0] += 59
+    assert svc.quotes(['AAPL'])['AAPL'] == 230.0 and len(fake.calls) == 1
+    clock[0] += 1
+    assert svc.quotes(['AAPL'])['AAPL'] == 231.0 and fake.calls[-1] == ['AAPL']
+
+def test_failing_symbol_does_not_affect_others(app, clock):
+    fake = FakePriceProvider({'7203.T': 2500.0, 'AAPL': 230.0}, failing={'DEAD'})
+    assert app.PriceService(fake).quotes(['7203.T', 'DEAD', 'AAPL']) == {'7203.T': 2500.0, 'AAPL': 230.0}
+
+def test_stale_price_is_kept_when_refresh_fails(app, clock):
+    fake = FakePriceProvider({'AAPL': 230.0})
+    svc = app.PriceService(fake, ttl=60)
+    svc.quotes(['AAPL'])
+    fake.failing.add('AAPL'); clock[0] += 120
+    assert svc.quotes(['AAPL']) == {'AAPL': 230.0}
+    assert len(fake.calls) == 2
+
+def test_failures_are_not_refetched_until_fail_ttl(app, clock):
+    fake = FakePriceProvider({'AAPL': 230.0}, failing={'DEAD'})
+    svc = app.PriceService(fake, ttl=600, fail_ttl=30)
+    svc.quotes(['AAPL', 'DEAD'])
+    clock[0] += 29
+    svc.quotes(['AAPL', 'DEAD'])
+    assert len(fake.calls) == 1
+    clock[0] += 1
+    svc.quotes(['AAPL', 'DEAD'])
+    assert fake.calls[-1] == ['DEAD']
+
+def test_concurrent_quotes_fetch_once(app):
+    fake = FakePriceProvider({f'S{i}': float(i) for i in range(40)}, latency=0.2)
+    svc = app.PriceService(fake)
+    symbols = [f'S{i}' for i in range(40)]
+    results, start = [], threading.Barrier(8)
+    def session():
+        start.wait(); results.append(svc.quotes(symbols))
+    threads = [threading.Thread(target=session) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(fake.calls) == 1 and all(len(r) == 40 for r in results)
+
+def test_price_provider_is_selected_by_env(app, monkeypatch):
+    monkeypatch.setitem(app.PRICE_PROVIDERS, 'fake', FakePriceProvider)
+    monkeypatch.setenv('PRICE_PROVIDER', 'fake')
+    assert isinstance(app.get_price_provider(), FakePriceProvider)
+    monkeypatch.setenv('PRICE_PROVIDER', 'nope')
+    assert app.get_price_provider() is None
@@ -0,0 +1,67 @@
+import pandas as pd
+import pytest
+
+class _Req:
+    def __init__(self, fn): self.fn = fn
+    def execute(self): return self.fn()
+
+class FakeSheetValues:
+    """values() の get / update / append だけを持つ Sheets API の代わり。
+    fail_get=True で get が、fail_append_after=n で n 回目より後の append が API エラーになる"""
+    def __init__(self, rows=None, fail_get=False, fail_append_after=None):
+        self.rows = [list(r) for r in rows or []]
+        self.fail_get, self.fail_append_after, self.appends = fail_get, fail_append_after, 0
+
+    def values(self): return self
+
+    def get(self, spreadsheetId, range, **kw):
+        def f():
+            if self.fail_get: raise RuntimeError('503 backend error')
+            i = 0 if range.endswith('!1:1') else 1      # 'S!1:1' / 'S!A2:ZZ2'
+            return {'values': [self.rows[i]]} if len(self.rows) > i and any(self.rows[i]) else {}
+        return _Req(f)
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def f():
+            if self.rows: self.rows[0] = list(body['values'][0])
+            else: self.rows.append(list(body['values'][0]))
+            return {}
+        return _Req(f)
+
+    def append(self, spreadsheetId, range, valueInputOption, body, insertDataOption=None):
+        def f():
+            self.appends += 1
+            if self.fail_append_after is not None and self.appends > self.fail_append_after:
+                raise RuntimeError('429 quota exceeded')
+            start = len(self.rows) + 1
+            self.rows += [list(r) for r in body['values']]
+            return {'updates': {'updatedRange': f"Trade_Log!A{start}:U{len(self.rows)}"}}
+        return _Req(f)
+
+ROWS = pd.DataFrame({'id': ['a', 'b', 'c', 'd', 'e'], 'tag_medium': ['m1', 'm2', 'm3', 'm4', 'm5']})
+
+def test_header_read_error_does_not_overwrite_header(app):
+    legacy = ['id', 'tag_detail', 'extra']
+    client = FakeSheetValues([legacy], fail_get=True)
+    assert app.append_sheet(client, 'sid', 'Trade_Log', ROWS) is False
+    assert client.rows == [legacy]
+
+def test_legacy_layout_is_kept(app):
+    client = FakeSheetValues([['tag_detail', 'id', 'extra']])
+    assert app.append_sheet(client, 'sid', 'Trade_Log', ROWS.head(1))
+    assert client.rows == [['tag_detail', 'id', 'extra'], ['m1', 'a', '']]
+
+def test_header_written_only_to_empty_sheet(app):
+    client = FakeSheetValues([])
+    assert app.append_sheet(client, 'sid', 'Trade_Log', ROWS.head(1))
+    assert client.rows == [['id', 'tag_medium'], ['a', 'm1']]
+    headless = FakeSheetValues([[], ['x', 'y']])
+    assert app.append_sheet(headless, 'sid', 'Trade_Log', ROWS.head(1)) is False
+    assert headless.rows == [[], ['x', 'y']]
+
+def test_partial_append_reports_written_rows(app):
+    client = FakeSheetValues([['id', 'tag_medium']], fail_append_after=1)
+    written = []
+    assert app.append_sheet(client, 'sid', 'Trade_Log', ROWS, chunk_rows=2, written=written) is False
+    assert [rows for _, _, rows in written] == [[['a', 'm1'], ['b', 'm2']]]
+    assert written[0][0] == 0 and len(client.rows) == 3
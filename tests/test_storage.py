@@ -0,0 +1,35 @@
+from datetime import date
+import pandas as pd
+import pytest
+from helpers import synth_tradelog_rows
+from test_analytics import PERIODS, assert_same
+
+@pytest.fixture
+def sqlite_store(app, tmp_path):
+    store = app.SQLiteStorage(str(tmp_path / 'tradelog.db'))
+    store.init()
+    store.write(app.TRADELOG_SHEET, synth_tradelog_rows(app.TRADELOG_COLS, 2000, seed=4))
+    return store
+
+def test_sqlite_indexes(app, sqlite_store):
+    with sqlite_store._db() as con:
+        names = {r[1] for r in con.execute(f"PRAGMA index_list({app._q(app.TRADELOG_SHEET)})")}
+        plan = lambda sql: ' '.join(r[3] for r in con.execute('EXPLAIN QUERY PLAN ' + sql, ('x',)))
+        assert 'ix_Trade_Log_trade_key' in plan('UPDATE "Trade_Log" SET memo = 1 WHERE "trade_key" = ?')
+        assert 'ix_Trade_Log_trade_date' in plan('SELECT * FROM "Trade_Log" WHERE trade_date >= ?')
+    assert {f'ix_{app.TRADELOG_SHEET}_{c}' for c in ['trade_date', 'ticker', 'id', 'trade_key']} <= names
+
+@pytest.mark.parametrize('start,end', PERIODS)
+def test_read_range_matches_filtered_full_read(app, sqlite_store, start, end):
+    header, rows = sqlite_store.read_rows(app.TRADELOG_SHEET)
+    full = app._normalize_tradelog(app._rows_to_frame(header, rows))
+    pd.testing.assert_frame_equal(sqlite_store.read_range(start, end), app._filter_range(full, start, end),
+                                  check_categorical=False, check_dtype=False)
+
+@pytest.mark.parametrize('start,end', PERIODS[1:])
+def test_sqlite_period_cube_matches_shared_frame(app, sqlite_store, start, end):
+    header, rows = sqlite_store.read_rows(app.TRADELOG_SHEET)
+    df = app.sorted_tradelog('test-sqlite', app._normalize_tradelog(app._rows_to_frame(header, rows)))
+    key = f'test-sqlite-{start}-{end}'
+    assert_same(app.analytics_cube(key + '-mem', start, end, df),
+                app.analytics_cube(key + '-db', start, end, df, sqlite_store))
@@ -0,0 +1,14 @@
+import pandas as pd
+
+def test_valid_tag_paths(app):
+    rows = pd.DataFrame([
+        ('', '', ''),                                      # タグなし
+        ('順張り', '', ''),                                 # 大だけ
+        ('順張り', '新高値ブレイク', ''),                    # 大 / 中
+        ('順張り', '新高値ブレイク', '初動買い'),             # 大 / 中 / 小
+        ('逆張り', '新高値ブレイク', ''),                    # 別の大分類の中分類
+        ('順張り', 'MAパーフェクトオーダー', '初動買い'),      # 別の中分類の小分類
+        ('順張り', '', '初動買い'),                          # 中が空で小だけ
+        ('', '新高値ブレイク', ''),                          # 大が空
+    ], columns=app.TAG_COLS)
+    assert app.valid_tag_paths(rows).tolist() == [True, True, True, True, False, False, False, False]
@@ -0,0 +1,57 @@
+import io
+import pandas as pd
+import pytest
+from helpers import synth_broker_csv
+
+def realized(app, fmt_name, n=300, seed=0):
+    data = synth_broker_csv(fmt_name, n, seed).to_csv(index=False).encode('cp932')
+    parser = app.CSV_PARSERS[f'parse_{fmt_name}']
+    return parser(app.read_csv_auto(io.BytesIO(data), usecols=app.CSV_USECOLS[parser]))
+
+def base(keys):
+    return keys.str.rsplit('#', n=1).str[0]
+
+def test_same_day_trades_of_one_ticker_get_different_keys(app):
+    r = realized(app, 'realized_jp', 1)
+    twin = pd.concat([r, r.assign(quantity=r['quantity'] + 100, realized_pl=r['realized_pl'] + 1)], ignore_index=True)
+    keys = app.trade_keys(twin)
+    assert keys.nunique() == 2 and base(keys).nunique() == 2
+
+def test_identical_rows_are_numbered(app):
+    r = realized(app, 'realized_jp', 1)
+    keys = app.trade_keys(pd.concat([r, r, r], ignore_index=True))
+    assert base(keys).nunique() == 1
+    assert keys.str.rsplit('#', n=1).str[1].tolist() == ['0', '1', '2']
+
+def sheet_values(rows, typed):
+    """Trade_Log 行をシートから読んだ形に（typed=True は数値を数値、日付をシリアル値で受け取った場合）"""
+    rows = rows.assign(trade_key='')
+    if typed:
+        for c in ['quantity', 'sell_price', 'avg_cost', 'realized_pl']:
+            rows[c] = pd.to_numeric(rows[c]).astype(object)
+        for c in ['trade_date', 'build_date']:
+            d = pd.to_datetime(rows[c], errors='coerce')
+            rows[c] = ((d - pd.Timestamp('1899-12-30')).dt.days.astype(object)).where(d.notna(), '')
+    else:
+        rows = rows.astype(str)
+    return rows.columns.tolist(), rows.values.tolist()
+
+@pytest.mark.parametrize('typed', [False, True])
+@pytest.mark.parametrize('fmt_name', ['realized_jp', 'realized_us'])
+def test_keys_from_sheet_rows_match_fresh_upload(app, fmt_name, typed):
+    r = realized(app, fmt_name)
+    r = pd.concat([r, r.head(5)], ignore_index=True)   # 同内容の行も含む
+    r['trade_key'] = app.trade_keys(r)
+    old, new = app.build_trade_rows(r, today='2100-01-01')
+    assert len(new) == 0
+    header, vals = sheet_values(old[app.TRADELOG_COLS], typed)
+    legacy = app._fill_trade_keys(app._normalize_tradelog(app._rows_to_frame(header, vals)))
+    assert legacy['trade_key'].tolist() == r['trade_key'].tolist()
+
+def test_reimported_export_is_fully_skipped(app):
+    first = realized(app, 'realized_jp', seed=1)
+    stored = pd.Index(app.trade_keys(first))
+    again = realized(app, 'realized_jp', seed=1)
+    assert (stored.get_indexer(app.trade_keys(again)) >= 0).all()
+    more = pd.concat([again, realized(app, 'realized_jp', n=3, seed=9)], ignore_index=True)
+    assert (stored.get_indexer(app.trade_keys(more)) < 0).sum() == 3
@@ -7,9 +7,18 @@ from datetime import datetime, timedelta, date
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+import codecs
+import hashlib
+import io
 import json
 import os
-import uuid
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 try:
     import yfinance as yf
@@ -17,6 +26,22 @@ try:
 except ImportError:
     YFINANCE_AVAILABLE = False
 
+try:
+    import pyarrow  # Parquetミラーと、DuckDB に渡す Arrow 表（pyarrow.Table.from_pandas）用
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+try:
+    import duckdb  # ダッシュボード集計用（無ければ pandas で集計）
+    DUCKDB_AVAILABLE = PARQUET_AVAILABLE  # Arrow 表で渡すので pyarrow も必要
+except ImportError:
+    DUCKDB_AVAILABLE = False
+
+# Trade_Log は全セッションで1つのフレームを共有して浅いコピーで配るため Copy-on-Write を有効に（pandas 3 では既定）
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
 st.set_page_config(
     page_title="TradeLog",
     page_icon="📈",
@@ -229,6 +254,12 @@ TRADELOG_SHEET = 'Trade_Log'
 POSITIONS_SHEET = 'Positions'
 SETTINGS_SHEET = 'Settings'
 
+# 保有状態（quantity = 数量の純増減, held = 単価計算上の保有数, avg_price = 移動平均単価）
+POSITIONS_COLS = ['ticker', 'name', 'market', 'type', 'quantity', 'held', 'avg_price']
+
+# 追記1リクエストあたりの最大行数
+APPEND_CHUNK_ROWS = 5000
+
 TRADELOG_COLS = [
     'id', 'market',
     'ticker', 'name',
@@ -240,9 +271,26 @@ TRADELOG_COLS = [
     'satisfaction',
     'stop_loss_price', 'discipline',
     'memo',
-    'created_at'
+    'created_at',
+    'trade_key',
 ]
 
+# 読込時の型（ここに無い列は文字列のまま）。値の範囲に合わせて小さい型に詰める
+# （価格・損益は trade_key と合計に使うので float64 のまま、損益率は表示だけなので float32）
+TRADELOG_SCHEMA = {
+    'market': 'category', 'ticker': 'category', 'name': 'category',
+    'trade_date': 'datetime', 'build_date': 'datetime',
+    'quantity': 'Int32', 'sell_price': 'float', 'avg_cost': 'float',
+    'realized_pl': 'float', 'realized_pl_pct': 'float32',
+    'hold_days': 'Int32',
+    'tag_large': 'category', 'tag_medium': 'category', 'tag_small': 'category',
+    'satisfaction': 'Int8',
+    'stop_loss_price': 'float', 'discipline': 'Int8',
+    'created_at': 'datetime',
+}
+# 空欄を0扱いにする列
+TRADELOG_FILL = {'quantity': 0, 'realized_pl': 0.0, 'realized_pl_pct': 0.0}
+
 # ==================== タグ定義（3階層）====================
 # 大分類 → 中分類 → 小分類
 TAG_TREE = {
@@ -274,6 +322,12 @@ TAG_TREE = {
 
 LARGE_TAGS = list(TAG_TREE.keys())
 
+# ==================== ローカルミラー ====================
+# Trade_Log のローカル複製（Parquet）。コールドスタート時はここから即表示し、保存先とは裏で照合
+MIRROR_DIR = os.environ.get("TRADELOG_MIRROR_DIR", ".tradelog_mirror")
+# 列定義（TRADELOG_COLS）や旧カラム移行ルールを変えたら上げる → 古いミラーは破棄される
+MIRROR_SCHEMA_VERSION = 4
+
 TAG_COLORS = {
     '順張り':         '#00e676',
     '逆張り':         '#42a5f5',
@@ -283,8 +337,7 @@ TAG_COLORS = {
 
 TODAY = date.today()
 
-@st.cache_resource
-def get_sheets_client():
+def build_sheets_client():
     try:
         gcp = os.environ.get("GCP_SERVICE_ACCOUNT_JSON", "")
         if gcp:
@@ -306,13 +359,19 @@ def get_sid():
     try: return st.secrets.get("spreadsheet_id", "")
     except: return ""
 
+# 数値・日付を文字列化せずに受け取る（日付はシリアル値）
+TYPED_READ = {'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'SERIAL_NUMBER'}
+
+def _rows_to_frame(h, vals):
+    rows = [(v + [''] * len(h))[:len(h)] for v in vals]
+    return pd.DataFrame(rows, columns=h)
+
 def read_sheet(client, sid, sheet):
     try:
         r = client.values().get(spreadsheetId=sid, range=f"{sheet}!A:ZZ").execute()
         vals = r.get('values', [])
         if not vals: return pd.DataFrame()
-        h = vals[0]; rows = [v + [''] * (len(h) - len(v)) for v in vals[1:]]
-        return pd.DataFrame(rows, columns=h)
+        return _rows_to_frame(vals[0], vals[1:])
     except HttpError as e:
         if e.resp.status == 404: return pd.DataFrame()
         return pd.DataFrame()
@@ -330,158 +389,1067 @@ def write_sheet(client, sid, sheet, df):
     except Exception as e:
         st.error(f"書き込みエラー: {e}"); return False
 
-def ensure_sheet(client, sid, name):
+def read_header(client, sid, sheet):
+    """1行目（空シートなら []）。API エラーは呼び出し側へ（空と取り違えてヘッダーを上書きしないように）"""
+    r = client.values().get(spreadsheetId=sid, range=f"{sheet}!1:1").execute()
+    vals = r.get('values', [])
+    return vals[0] if vals else []
+
+def _range_row(rng):
+    # 'Trade_Log!A302:U310' -> 302（読めなければ 0）
+    digits = rng.rsplit('!', 1)[-1].split(':')[0].lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    return int(digits) if digits.isdigit() else 0
+
+def append_sheet(client, sid, sheet, df, chunk_rows=APPEND_CHUNK_ROWS, written=None):
+    """新規行だけを末尾に追記（既存行は送らない・消さない）。
+    written を渡すと書けたチャンクごとに (書き込み先のデータ行位置, ヘッダー, 行) を追加していく
+    （途中のチャンクで失敗しても、それまでに書いた行は written に残る）"""
+    if len(df) == 0: return True
     try:
-        r = client.get(spreadsheetId=sid).execute()
-        existing = [s['properties']['title'] for s in r.get('sheets', [])]
-        if name not in existing:
-            client.batchUpdate(spreadsheetId=sid, body={
-                'requests': [{'addSheet': {'properties': {'title': name}}}]
-            }).execute()
-    except: pass
+        header = read_header(client, sid, sheet)
+        if not header and client.values().get(spreadsheetId=sid, range=f"{sheet}!A2:ZZ2").execute().get('values'):
+            raise ValueError(f"{sheet} の1行目（ヘッダー）が空です。列の対応が分からないため追記しません")
+        # 旧カラム互換（tag_detail 列のシートには tag_medium をそこへ書く）
+        if 'tag_detail' in header and 'tag_medium' not in header:
+            df = df.rename(columns={'tag_medium': 'tag_detail'})
+        missing = [c for c in df.columns if c not in header]
+        if missing:
+            header = header + missing
+            client.values().update(
+                spreadsheetId=sid, range=f"{sheet}!A1",
+                valueInputOption='RAW', body={'values': [header]}
+            ).execute()
+        vals = df.reindex(columns=header).astype(object).fillna('').astype(str).values.tolist()
+        for i in range(0, len(vals), chunk_rows):
+            r = client.values().append(
+                spreadsheetId=sid, range=f"{sheet}!A1",
+                valueInputOption='RAW', insertDataOption='INSERT_ROWS',
+                body={'values': vals[i:i + chunk_rows]}
+            ).execute()
+            if written is not None:
+                written.append((_range_row(r.get('updates', {}).get('updatedRange', '')) - 2, header, vals[i:i + chunk_rows]))
+        return True
+    except Exception as e:
+        st.error(f"追記エラー: {e}"); return False
 
 def init_sheets(client, sid):
-    for s in [TRADELOG_SHEET, POSITIONS_SHEET, SETTINGS_SHEET]:
-        ensure_sheet(client, sid, s)
-    df = read_sheet(client, sid, TRADELOG_SHEET)
-    if len(df) == 0:
-        write_sheet(client, sid, TRADELOG_SHEET, pd.DataFrame(columns=TRADELOG_COLS))
+    """メタデータ1回取得 → 不足タブを1回のbatchUpdateで作成 → 空ならヘッダーのみ書き込み"""
+    r = client.get(spreadsheetId=sid, fields='sheets.properties.title').execute()
+    existing = {s['properties']['title'] for s in r.get('sheets', [])}
+    missing = [s for s in [TRADELOG_SHEET, POSITIONS_SHEET, SETTINGS_SHEET] if s not in existing]
+    if missing:
+        client.batchUpdate(spreadsheetId=sid, body={
+            'requests': [{'addSheet': {'properties': {'title': s}}} for s in missing]
+        }).execute()
+    if TRADELOG_SHEET in missing or not read_header(client, sid, TRADELOG_SHEET):
+        client.values().update(
+            spreadsheetId=sid, range=f"{TRADELOG_SHEET}!A1",
+            valueInputOption='RAW', body={'values': [TRADELOG_COLS]}
+        ).execute()
+
+# ==================== ストレージ ====================
+# TRADELOG_BACKEND=sheets（既定。GCP_SERVICE_ACCOUNT_JSON + SPREADSHEET_ID）/ sqlite（TRADELOG_DB_PATH のローカルファイル）
+# どちらも同じメソッドを持つ: init / read / write / append / read_rows / update_cells / read_range
+SQLITE_DB_PATH = 'tradelog.db'
+# SQLite の Trade_Log で索引を張る列（期間・銘柄の絞り込みと、id / trade_key での更新）
+SQLITE_INDEX_COLS = ['trade_date', 'ticker', 'id', 'trade_key']
+
+def get_backend():
+    b = os.environ.get("TRADELOG_BACKEND", "")
+    if b: return b.strip().lower()
+    try: return str(st.secrets.get("tradelog_backend", "sheets")).strip().lower()
+    except: return "sheets"
+
+def get_db_path():
+    path = os.environ.get("TRADELOG_DB_PATH", "")
+    if path: return path
+    try: return st.secrets.get("tradelog_db_path", SQLITE_DB_PATH)
+    except: return SQLITE_DB_PATH
+
+def _trim_row(row):
+    # Sheets API は末尾の空セルを返さないので、行の比較はこの形にそろえる
+    row = list(row)
+    while row and row[-1] == '': row.pop()
+    return row
+
+def _filter_range(df, start=None, end=None):
+    td = df['trade_date']
+    m = td.notna()
+    if start is not None: m &= td >= pd.Timestamp(start)
+    if end is not None: m &= td < pd.Timestamp(end) + timedelta(days=1)
+    return df[m].sort_values('trade_date', kind='stable').reset_index(drop=True)
+
+class SheetsStorage:
+    """Google Sheets（スプレッドシート1つ）。行番号 = データ行位置 + 2"""
+    label = 'Google Sheets'
+    indexed_range = False  # 期間読みも全件を読んでから絞る
+
+    def __init__(self, client, sid):
+        self.client, self.sid, self.key = client, sid, sid
+
+    def init(self): init_sheets(self.client, self.sid)
+    def read(self, sheet): return read_sheet(self.client, self.sid, sheet)
+    def write(self, sheet, df): return write_sheet(self.client, self.sid, sheet, df)
+
+    def append(self, sheet, df, written=None):
+        return append_sheet(self.client, self.sid, sheet, df, written=written)
+
+    def read_rows(self, sheet, start=0):
+        """(ヘッダー, start 番目以降のデータ行)。数値・日付は型付きで受け取る"""
+        if start == 0:
+            vals = self.client.values().get(spreadsheetId=self.sid, range=f"{sheet}!A:ZZ", **TYPED_READ).execute().get('values', [])
+            return (vals[0], vals[1:]) if vals else ([], [])
+        r = self.client.values().batchGet(spreadsheetId=self.sid, ranges=[
+            f"{sheet}!1:1", f"{sheet}!A{start + 2}:ZZ"], **TYPED_READ).execute()
+        vr = r.get('valueRanges', [{}, {}])
+        return (vr[0].get('values') or [[]])[0], vr[1].get('values', [])
+
+    def update_cells(self, sheet, header, key, pos, updates):
+        """pos 行目の updates（NaN = 変更なし）を1回の values().batchUpdate で。隣り合う列は1レンジにまとめる"""
+        ci = np.array([header.index(_sheet_col(header, c)) for c in updates.columns])
+        has, text = updates.notna().to_numpy(), updates.fillna('').astype(str).to_numpy()
+        data = []
+        for p, h, t in zip(pos, has, text):
+            j = np.flatnonzero(h)
+            for run in np.split(j, np.flatnonzero(np.diff(ci[j]) != 1) + 1) if len(j) else []:
+                data.append({'range': f"{sheet}!{_col_letter(ci[run[0]])}{p + 2}:{_col_letter(ci[run[-1]])}{p + 2}",
+                             'values': [list(t[run])]})
+        if data:
+            self.client.values().batchUpdate(spreadsheetId=self.sid, body={'valueInputOption': 'RAW', 'data': data}).execute()
+        return len(data) > 0
+
+    def read_range(self, start=None, end=None):
+        """trade_date が start〜end（両端含む）の Trade_Log（Sheets は全件読んでから絞る）"""
+        header, rows = self.read_rows(TRADELOG_SHEET)
+        return _filter_range(_normalize_tradelog(_rows_to_frame(header, rows)), start, end)
+
+def _q(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _sqlite_type(sheet, col):
+    # Trade_Log は列の型アフィニティで数値を数値のまま持つ（'' は文字列のまま残る）
+    kind = TRADELOG_SCHEMA.get(col, '') if sheet == TRADELOG_SHEET else ''
+    return 'INTEGER' if kind.startswith('Int') else 'REAL' if kind.startswith('float') else 'TEXT'
+
+class SQLiteStorage:
+    """ローカルの SQLite ファイル（API クォータなし）。シート1枚 = テーブル1つ、行順 = rowid 順。
+    接続は呼び出しごとに開くので、裏の同期スレッドからもそのまま使える"""
+    label = 'SQLite'
+    indexed_range = True   # 期間読みは trade_date の索引で絞る
+
+    def __init__(self, path):
+        self.path = path
+        self.key = 'sqlite-' + hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+
+    @contextmanager
+    def _db(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con: yield con
+        finally:
+            con.close()
+
+    def _header(self, con, sheet):
+        return [r[1] for r in con.execute(f"PRAGMA table_info({_q(sheet)})")]
+
+    def _create(self, con, sheet, cols):
+        con.execute(f"CREATE TABLE IF NOT EXISTS {_q(sheet)} ({', '.join(f'{_q(c)} {_sqlite_type(sheet, c)}' for c in cols)})")
+        if sheet == TRADELOG_SHEET:
+            for c in SQLITE_INDEX_COLS:
+                con.execute(f"CREATE INDEX IF NOT EXISTS {_q(f'ix_{sheet}_{c}')} ON {_q(sheet)} ({_q(c)})")
+
+    def init(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._db() as con:
+            con.execute("PRAGMA journal_mode=WAL")  # 読み取りと書き込みが互いを待たない
+            self._create(con, TRADELOG_SHEET, TRADELOG_COLS)
+
+    def read(self, sheet):
+        try:
+            with self._db() as con:
+                header = self._header(con, sheet)
+                if not header: return pd.DataFrame()
+                rows = con.execute(f"SELECT * FROM {_q(sheet)} ORDER BY rowid").fetchall()
+            return _rows_to_frame(header, [['' if v is None else str(v) for v in r] for r in rows])
+        except Exception: return pd.DataFrame()
+
+    def write(self, sheet, df):
+        try:
+            with self._db() as con:
+                con.execute(f"DROP TABLE IF EXISTS {_q(sheet)}")
+                self._create(con, sheet, df.columns.tolist())
+                con.executemany(f"INSERT INTO {_q(sheet)} VALUES ({', '.join('?' * len(df.columns))})",
+                                df.astype(object).fillna('').astype(str).values.tolist())
+            return True
+        except Exception as e:
+            st.error(f"書き込みエラー: {e}"); return False
+
+    def append(self, sheet, df, written=None):
+        """末尾に追記（1トランザクション）。written には読み直した型付きの行を渡す"""
+        if len(df) == 0: return True
+        try:
+            with self._db() as con:
+                con.execute("BEGIN IMMEDIATE")  # 行数の確認から追記までを他の書き込みと分ける
+                header = self._header(con, sheet)
+                missing = [c for c in df.columns if c not in header]
+                if not header:
+                    self._create(con, sheet, missing)
+                else:
+                    for c in missing:
+                        con.execute(f"ALTER TABLE {_q(sheet)} ADD COLUMN {_q(c)} {_sqlite_type(sheet, c)}")
+                header = header + missing
+                start, last_id = con.execute(f"SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM {_q(sheet)}").fetchone()
+                vals = df.reindex(columns=header).astype(object).fillna('').astype(str).values.tolist()
+                con.executemany(f"INSERT INTO {_q(sheet)} VALUES ({', '.join('?' * len(header))})", vals)
+                if written is not None:
+                    rows = con.execute(f"SELECT * FROM {_q(sheet)} WHERE rowid > ? ORDER BY rowid", (last_id,))
+                    written.append((start, header, [['' if v is None else v for v in r] for r in rows]))
+            return True
+        except Exception as e:
+            st.error(f"追記エラー: {e}"); return False
+
+    def read_rows(self, sheet, start=0):
+        """(ヘッダー, start 番目以降のデータ行)。値は列の型のまま"""
+        with self._db() as con:
+            header = self._header(con, sheet)
+            rows = con.execute(f"SELECT * FROM {_q(sheet)} ORDER BY rowid LIMIT -1 OFFSET ?", (start,)).fetchall() if header else []
+        return header, [['' if v is None else v for v in r] for r in rows]
+
+    def update_cells(self, sheet, header, key, pos, updates):
+        """key 列の値で行を特定して updates（NaN = 変更なし）を書く（key の索引を使う）"""
+        n = 0
+        with self._db() as con:
+            for k, row in zip(updates.index.astype(str), updates.to_dict('records')):
+                cells = {_sheet_col(header, c): v for c, v in row.items() if pd.notna(v)}
+                if not cells: continue
+                con.execute(f"UPDATE {_q(sheet)} SET {', '.join(f'{_q(c)} = ?' for c in cells)} WHERE {_q(key)} = ?",
+                            [str(v) for v in cells.values()] + [k])
+                n += 1
+        return n > 0
+
+    def read_range(self, start=None, end=None):
+        """trade_date が start〜end（両端含む）の Trade_Log（trade_date の索引で絞る）"""
+        lo = '' if start is None else pd.Timestamp(start).strftime('%Y-%m-%d')
+        hi = '9999' if end is None else (pd.Timestamp(end) + timedelta(days=1)).strftime('%Y-%m-%d')
+        with self._db() as con:
+            header = self._header(con, TRADELOG_SHEET)
+            rows = con.execute(f"SELECT * FROM {_q(TRADELOG_SHEET)} WHERE trade_date >= ? AND trade_date < ? "
+                               f"ORDER BY trade_date, rowid", (lo, hi)).fetchall()
+        rows = [['' if v is None else v for v in r] for r in rows]
+        return _filter_range(_normalize_tradelog(_rows_to_frame(header, rows)), start, end)
+
+def build_storage():
+    """設定されたバックエンドのストア（未設定・接続できなければ None）。スレッドごとに作る"""
+    if get_backend() == 'sqlite':
+        return SQLiteStorage(get_db_path())
+    client, sid = build_sheets_client(), get_sid()
+    return SheetsStorage(client, sid) if client and sid else None
+
+@st.cache_resource
+def get_storage():
+    return build_storage()
+
+@st.cache_resource
+def bootstrap_storage(key):
+    """プロセス×ストアごとに1回だけ実行（失敗時はキャッシュされず次回再試行）"""
+    store = get_storage()
+    if not store: return False
+    store.init()
+    return True
 
 # ==================== CSV ヘルパー ====================
-def read_csv_auto(file):
-    for enc in ['cp932', 'utf-8-sig', 'utf-8', 'shift_jis', 'latin-1']:
+# 文字コード判定に使う先頭バイト数と、CSV読込のチャンク行数
+CSV_SAMPLE_BYTES = 256 * 1024
+CSV_CHUNK_ROWS = 50_000
+
+def detect_encoding(sample):
+    """BOM → UTF-8 → CP932 の順に先頭サンプルを試し読み（末尾で切れた文字は許容）"""
+    if sample.startswith(codecs.BOM_UTF8): return 'utf-8-sig'
+    for enc in ['utf-8', 'cp932']:
         try:
-            file.seek(0)
-            return pd.read_csv(file, encoding=enc)
-        except: continue
+            codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return 'latin-1'
+
+def read_csv_auto(file, usecols=None):
+    """文字コードを判定して1回だけパース。usecols 指定時はその列だけ読む"""
+    file.seek(0)
+    enc = detect_encoding(file.read(CSV_SAMPLE_BYTES))
     file.seek(0)
-    return pd.read_csv(file, encoding='latin-1')
+    cols = set(usecols) if usecols else None
+    chunks = pd.read_csv(file, encoding=enc, encoding_errors='replace', dtype=str,
+                         usecols=(lambda c: c.strip() in cols) if cols else None,
+                         chunksize=CSV_CHUNK_ROWS)
+    return pd.concat(chunks, ignore_index=True)
+
+# ==================== 証券会社CSVフォーマット ====================
+# 出力列 → (CSV列, 変換)。変換: code=銘柄コード正規化 / text=前後空白除去 / raw / date / int / num
+# CSV列が None の出力列は空、market は固定値。CSV列が無い date 列は NaT
+BROKER_FORMATS = {
+    'realized_jp': {'market': '日本株', 'cols': {
+        'ticker': ('銘柄コード', 'code'), 'name': ('銘柄名', 'raw'),
+        'trade_date': ('約定日', 'date'), 'build_date': ('建約定日', 'date'),
+        'quantity': ('数量[株]', 'int'), 'sell_price': ('売却/決済単価[円]', 'num'),
+        'avg_cost': ('平均取得価額[円]', 'num'), 'realized_pl': ('実現損益[円]', 'num'),
+    }},
+    'realized_us': {'market': '米国株', 'cols': {
+        'ticker': ('ティッカーコード', 'text'), 'name': ('銘柄名', 'raw'),
+        'trade_date': ('約定日', 'date'), 'build_date': (None, 'date'),
+        'quantity': ('数量[株]', 'int'), 'sell_price': ('売却/決済単価[USドル]', 'num'),
+        'avg_cost': ('平均取得価額[円]', 'num'), 'realized_pl': ('実現損益[円]', 'num'),
+    }},
+    'history_jp': {'market': '日本株', 'cols': {
+        'trade_date': ('約定日', 'date'), 'ticker': ('銘柄コード', 'code'), 'name': ('銘柄名', 'raw'),
+        'trade_type': ('取引区分', 'raw'), 'action': ('売買区分', 'raw'),
+        'quantity': ('数量［株］', 'int'), 'price': ('単価［円］', 'num'),
+        'build_date': ('建約定日', 'date'),
+    }},
+    'history_us': {'market': '米国株', 'cols': {
+        'trade_date': ('約定日', 'date'), 'ticker': ('ティッカー', 'text'), 'name': ('銘柄名', 'raw'),
+        'trade_type': ('取引区分', 'raw'), 'action': ('売買区分', 'raw'),
+        'quantity': ('数量［株］', 'int'), 'price': ('単価［USドル］', 'num'),
+        'build_date': (None, 'date'),
+    }},
+}
 
 def _clean_num(s):
-    return pd.to_numeric(
-        s.astype(str).str.replace(',','').str.replace('−','-').str.strip(),
-        errors='coerce'
-    ).fillna(0)
-
-def parse_realized_jp(df):
-    df = df.copy(); df.columns = df.columns.str.strip()
-    result = pd.DataFrame({
-        'market': '日本株',
-        'ticker': df['銘柄コード'].astype(str).str.strip().apply(
-            lambda x: str(int(float(x))) if x.replace('.','').isdigit() else x),
-        'name': df['銘柄名'],
-        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
-        'build_date': '',
-        'quantity': _clean_num(df['数量[株]']).astype(int),
-        'sell_price': _clean_num(df['売却/決済単価[円]']),
-        'avg_cost': _clean_num(df['平均取得価額[円]']),
-        'realized_pl': _clean_num(df['実現損益[円]']),
-    })
-    if '建約定日' in df.columns:
-        result['build_date'] = pd.to_datetime(df['建約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d')
-    result['realized_pl_pct'] = np.where(
-        result['avg_cost'] > 0,
-        (result['realized_pl'] / (result['avg_cost'] * result['quantity']) * 100).round(2), 0.0)
-    result['hold_days'] = ''
+    s = s.astype(str).str.replace(',', '', regex=False).str.replace('−', '-', regex=False).str.strip()
+    # 数値だけの列は高速な astype、'-' や空欄が混じる列だけ to_numeric
+    try:
+        num = s.astype(float)
+        # to_numeric と同じく整数だけの列は int のまま
+        if num.notna().all() and (num % 1 == 0).all(): return num.astype('int64')
+    except (ValueError, TypeError):
+        num = pd.to_numeric(s, errors='coerce')
+    return num.fillna(0)
+
+def _norm_code(s):
+    # 数字だけのコードは "7203.0" / "07203" → "7203"、英字入りはそのまま
+    return s.astype(str).str.strip().str.replace(r'^0*(\d+?)(?:\.\d*)?$', r'\1', regex=True)
+
+def _convert(s, kind):
+    if kind == 'code': return _norm_code(s)
+    if kind == 'text': return s.astype(str).str.strip()
+    if kind == 'raw':  return s
+    if kind == 'date': return pd.to_datetime(s, format='%Y/%m/%d', errors='coerce')
+    if kind == 'int':  return _clean_num(s).astype(int)
+    return _clean_num(s)
+
+def fmt_date(v):
+    """Timestamp → 'YYYY-MM-DD'（NaT・空は ''）"""
+    return '' if v is None or pd.isna(v) or v == '' else pd.Timestamp(v).strftime('%Y-%m-%d')
+
+def parse_broker_csv(df, fmt_name):
+    """BROKER_FORMATS の定義に従って列ごとにベクトル変換（日付は datetime64 のまま）"""
+    fmt = BROKER_FORMATS[fmt_name]
+    df = df.rename(columns=lambda c: c.strip())
+    out = {'market': fmt['market']}
+    for col, (src, kind) in fmt['cols'].items():
+        if src is not None and src in df.columns:
+            out[col] = _convert(df[src], kind)
+        else:
+            out[col] = pd.Series(pd.NaT if kind == 'date' else '', index=df.index)
+    result = pd.DataFrame(out, index=df.index)
+    if 'realized_pl' in result.columns:
+        result['realized_pl_pct'] = np.where(
+            result['avg_cost'] > 0,
+            (result['realized_pl'] / (result['avg_cost'] * result['quantity']) * 100).round(2), 0.0)
+        result['hold_days'] = ''
     return result
 
-def parse_realized_us(df):
-    df = df.copy(); df.columns = df.columns.str.strip()
-    result = pd.DataFrame({
-        'market': '米国株',
-        'ticker': df['ティッカーコード'].astype(str).str.strip(),
-        'name': df['銘柄名'],
-        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
-        'build_date': '',
-        'quantity': _clean_num(df['数量[株]']).astype(int),
-        'sell_price': _clean_num(df['売却/決済単価[USドル]']),
-        'avg_cost': _clean_num(df['平均取得価額[円]']),
-        'realized_pl': _clean_num(df['実現損益[円]']),
-    })
-    result['realized_pl_pct'] = np.where(
-        result['avg_cost'] > 0,
-        (result['realized_pl'] / result['avg_cost'] / result['quantity'] * 100).round(2), 0.0)
-    result['hold_days'] = ''
-    return result
+def parse_realized_jp(df): return parse_broker_csv(df, 'realized_jp')
+def parse_realized_us(df): return parse_broker_csv(df, 'realized_us')
+def parse_history_jp(df):  return parse_broker_csv(df, 'history_jp')
+def parse_history_us(df):  return parse_broker_csv(df, 'history_us')
 
-def parse_history_jp(df):
-    df = df.copy(); df.columns = df.columns.str.strip()
-    return pd.DataFrame({
-        'market': '日本株',
-        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
-        'ticker': df['銘柄コード'].astype(str).str.strip().apply(
-            lambda x: str(int(float(x))) if x.replace('.','').isdigit() else x),
-        'name': df['銘柄名'],
-        'trade_type': df['取引区分'],
-        'action': df['売買区分'],
-        'quantity': _clean_num(df['数量［株］']).astype(int),
-        'price': _clean_num(df['単価［円］']),
-        'build_date': pd.to_datetime(df['建約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d') if '建約定日' in df.columns else '',
-    })
+# 各パーサーが使う列（CSV読込時にこれ以外は読まない）
+CSV_USECOLS = {
+    parser: [src for src, _ in BROKER_FORMATS[parser.__name__[len('parse_'):]]['cols'].values() if src]
+    for parser in [parse_realized_jp, parse_realized_us, parse_history_jp, parse_history_us]
+}
 
-def parse_history_us(df):
-    df = df.copy(); df.columns = df.columns.str.strip()
-    return pd.DataFrame({
-        'market': '米国株',
-        'trade_date': pd.to_datetime(df['約定日'], format='%Y/%m/%d', errors='coerce').dt.strftime('%Y-%m-%d'),
-        'ticker': df['ティッカー'].astype(str).str.strip(),
-        'name': df['銘柄名'],
-        'trade_type': df['取引区分'],
-        'action': df['売買区分'],
-        'quantity': _clean_num(df['数量［株］']).astype(int),
-        'price': _clean_num(df['単価［USドル］']),
-        'build_date': '',
-    })
+CSV_PARSERS = {p.__name__: p for p in CSV_USECOLS}
+# パーサーの出力仕様を変えたら上げる（取込キャッシュを無効化）
+PARSER_VERSION = 2
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _parse_upload_cached(digest, parser_name, version, _data):
+    parser = CSV_PARSERS[parser_name]
+    return parser(read_csv_auto(io.BytesIO(_data), usecols=CSV_USECOLS[parser]))
+
+def parse_upload(f, parser):
+    """アップロード内容のハッシュ＋パーサー版ごとにパース結果を再利用（再実行時は再パースしない）"""
+    data = f.getvalue()
+    return _parse_upload_cached(hashlib.sha1(data).hexdigest(), parser.__name__, PARSER_VERSION, data)
+
+def _moving_avg_cost(rows, buy_mask, sell_mask):
+    """ticker ごとの移動平均取得単価と保有数（rows は約定日順）。
+    保有数は0未満にならず、売却で0になったら単価もリセット（逐次計算と同じ規則）"""
+    q = rows['quantity'].to_numpy(dtype=float)
+    d = np.where(buy_mask, q, np.where(sell_mask, -q, 0.0))
+    key = rows['ticker'].to_numpy()
+    s = pd.Series(d).groupby(key).cumsum()
+    held = s - np.minimum(s.groupby(key).cummin(), 0)
+    final_held = held.groupby(key).last()
+    # 最後に保有0になった時点以降（最終セグメント）だけが単価に効く
+    seg = held.eq(0).groupby(key).cumsum()
+    last = (seg == seg.groupby(key).transform('max')).to_numpy()
+    held, q, d, key = held.to_numpy()[last], q[last], d[last], key[last]
+    buy = d > 0
+    # 売却は保有数と簿価を同じ比率で縮める → 各買付の残存比率 w で加重平均
+    sell = (d < 0) & (held > 0)
+    logf = np.zeros(len(q))
+    logf[sell] = np.log(held[sell] / (held[sell] + q[sell]))
+    cum = pd.Series(logf).groupby(key).cumsum()
+    w = np.exp(cum.groupby(key).transform('last') - cum).to_numpy()
+    p = rows['price'].to_numpy(dtype=float)[last]
+    num = pd.Series(np.where(buy, p * q * w, 0.0)).groupby(key).sum()
+    den = pd.Series(np.where(buy, q * w, 0.0)).groupby(key).sum()
+    return pd.DataFrame({'held': final_held, 'avg_price': (num / den).where(den > 0, 0.0)})
+
+def empty_position_state():
+    return pd.DataFrame(columns=POSITIONS_COLS)
+
+def apply_fills(state, df_hist):
+    """保有状態（ticker×type ごとの数量・保有数・移動平均単価）に約定を適用した新しい状態を返す"""
+    if len(df_hist) == 0: return state
+    h = df_hist.sort_values('trade_date', kind='stable').reset_index(drop=True)
+    act, ttype = h['action'], h['trade_type']
+    tickers = pd.Index(pd.unique(pd.concat([state['ticker'], df_hist['ticker']], ignore_index=True)))
+    prev = state.set_index(['ticker', 'type'])
+    info = pd.concat([
+        state.drop_duplicates('ticker', keep='last').set_index('ticker')[['name', 'market']],
+        h.drop_duplicates('ticker', keep='last').set_index('ticker')[['name', 'market']],
+    ])
+    info = info[~info.index.duplicated(keep='last')].reindex(tickers)
+
+    def qty_by_ticker(mask):
+        return h['quantity'].where(mask, 0).groupby(h['ticker']).sum().reindex(tickers, fill_value=0)
+
+    def prev_col(typ, col):
+        return pd.to_numeric(prev.xs(typ, level='type')[col], errors='coerce').reindex(tickers, fill_value=0) \
+            if typ in prev.index.get_level_values('type') else pd.Series(0.0, index=tickers)
+
+    is_spot = ttype.isin(['現物','現引']) | (h['market']=='米国株')
+    spot_qty = qty_by_ticker(is_spot & act.isin(['買付','入庫'])) - qty_by_ticker(is_spot & (act=='売付'))
+    margin_qty = (qty_by_ticker(act=='買建') - qty_by_ticker(act=='売埋')
+                  - qty_by_ticker(ttype=='現引'))
+
+    # 前回までの保有は「保有数×平均単価の買付1件」として先頭に置けば移動平均がそのまま続く
+    def seed(typ, action, trade_type):
+        held, avg = prev_col(typ, 'held'), prev_col(typ, 'avg_price')
+        held = held[held > 0]
+        return pd.DataFrame({'ticker': held.index, 'trade_date': pd.NaT, 'action': action,
+                             'trade_type': trade_type, 'market': info.loc[held.index, 'market'].to_numpy(),
+                             'quantity': held.to_numpy(), 'price': avg[held.index].to_numpy()})
+
+    spot = pd.concat([seed('spot', '買付', '現物'), h[is_spot]], ignore_index=True)
+    jp_ticker = spot['ticker'].map(info['market']).eq('日本株')
+    spot_cost = _moving_avg_cost(
+        spot, (spot['action']=='買付') | (jp_ticker & (spot['action']=='入庫')), spot['action']=='売付')
+    margin = pd.concat([seed('margin', '買建', '信用新規'), h[act.isin(['買建','売埋'])]], ignore_index=True)
+    margin_cost = _moving_avg_cost(margin, margin['action']=='買建', margin['action']=='売埋')
+
+    parts = []
+    for typ, qty, cost in [('spot', spot_qty, spot_cost), ('margin', margin_qty, margin_cost)]:
+        cost = cost.reindex(tickers, fill_value=0.0)
+        parts.append(pd.DataFrame({
+            'ticker': tickers, 'name': info['name'].to_numpy(), 'market': info['market'].to_numpy(),
+            'type': typ, 'quantity': (prev_col(typ, 'quantity') + qty).astype(int).to_numpy(),
+            'held': cost['held'].astype(int).to_numpy(), 'avg_price': cost['avg_price'].to_numpy(),
+        }))
+    result = pd.concat(parts, ignore_index=True)
+    result = result[(result['quantity'] != 0) | (result['held'] != 0)]
+    # 銘柄の出現順（既存状態 → 新規約定）→ 現物・信用の順
+    result['_o'] = result['ticker'].map({t: i for i, t in enumerate(tickers)}) * 2 + (result['type'] == 'margin')
+    return result.sort_values('_o').drop(columns='_o').reset_index(drop=True)[POSITIONS_COLS]
+
+def positions_view(state):
+    """保有タブ表示用（数量 > 0 のみ）"""
+    pos = state[pd.to_numeric(state['quantity']) > 0]
+    if len(pos) == 0: return pd.DataFrame()
+    pos = pos[['ticker','name','market','type','quantity']].assign(
+        quantity=pd.to_numeric(pos['quantity']).astype(int),
+        avg_price=[round(float(v), 2) for v in pos['avg_price']])
+    return pos.reset_index(drop=True)
 
 def calc_positions(df_hist):
     if len(df_hist) == 0: return pd.DataFrame()
-    result = []
-    for ticker in df_hist['ticker'].unique():
-        sub = df_hist[df_hist['ticker'] == ticker].sort_values('trade_date')
-        name = sub['name'].iloc[-1]; market = sub['market'].iloc[-1]
-        spot = sub[sub['trade_type'].isin(['現物','現引']) | (sub['market']=='米国株')]
-        spot_qty = spot[spot['action'].isin(['買付','入庫'])]['quantity'].sum() - spot[spot['action']=='売付']['quantity'].sum()
-        kenin = sub[sub['trade_type']=='現引']['quantity'].sum()
-        margin_qty = sub[sub['action']=='買建']['quantity'].sum() - sub[sub['action']=='売埋']['quantity'].sum() - kenin
-
-        def avg_price(rows, buy_acts, sell_act):
-            qty, avg = 0.0, 0.0
-            for _, r in rows.sort_values('trade_date').iterrows():
-                q = float(r['quantity']); p = float(r['price'])
-                if r['action'] in buy_acts:
-                    avg = (avg*qty + p*q)/(qty+q) if (qty+q)>0 else 0; qty += q
-                elif r['action'] == sell_act:
-                    qty = max(0, qty-q)
-                    if qty == 0: avg = 0
-            return round(avg, 2)
-
-        if spot_qty > 0:
-            buy_acts = ['買付','入庫'] if market=='日本株' else ['買付']
-            result.append({'ticker':ticker,'name':name,'market':market,'type':'spot',
-                           'quantity':int(spot_qty),'avg_price':avg_price(spot,buy_acts,'売付')})
-        if margin_qty > 0:
-            result.append({'ticker':ticker,'name':name,'market':market,'type':'margin',
-                           'quantity':int(margin_qty),
-                           'avg_price':avg_price(sub[sub['action'].isin(['買建','売埋'])],['買建'],'売埋')})
-    return pd.DataFrame(result) if result else pd.DataFrame()
-
-# ==================== Sheets キャッシュ ====================
-@st.cache_data(ttl=300)
-def load_tradelog_cached(sid):
-    client = get_sheets_client()
-    if not client: return pd.DataFrame(columns=TRADELOG_COLS)
-    df = read_sheet(client, sid, TRADELOG_SHEET)
-    if len(df) == 0: return pd.DataFrame(columns=TRADELOG_COLS)
+    return positions_view(apply_fills(empty_position_state(), df_hist))
+
+def fill_keys(df_hist):
+    """約定行の内容ハッシュ（同内容の約定は出現順の連番で区別）"""
+    cols = ['trade_date','ticker','trade_type','action','quantity','price']
+    h = df_hist[cols].assign(trade_date=df_hist['trade_date'].dt.strftime('%Y-%m-%d')).astype(str)
+    h = pd.util.hash_pandas_object(h, index=False).astype(str)
+    return h + '#' + h.groupby(h).cumcount().astype(str)
+
+# 反映済みの約定キーを残す日数（前回の取込と重なった約定はこの期間内ならキーで見分ける）
+FILL_KEY_DAYS = 60
+
+def _norm_watermark(wm):
+    # 旧形式 {'date', 'keys': [その日のキー]} → {'first', 'date', 'since', 'keys': {日付: [キー]}}
+    # since 以降に反映した約定はすべて keys にある。first は最初に反映した約定日（旧形式では不明）
+    if not wm or isinstance(wm.get('keys'), dict): return wm
+    return {'first': '', 'date': wm['date'], 'since': wm['date'], 'keys': {wm['date']: list(wm.get('keys', []))}}
+
+def unapplied_fills(df_hist, keys, watermark):
+    """未反映の約定（since 以降は反映済みキーと照合、since より前は反映済みとみなす）"""
+    if not watermark: return pd.Series(True, index=df_hist.index)
+    known = {k for ks in watermark['keys'].values() for k in ks}
+    return (df_hist['trade_date'] >= pd.Timestamp(watermark['since'])) & ~keys.isin(known)
+
+def next_watermark(df_hist, keys, watermark):
+    """今回反映した約定（df_hist とそのキー）を加えたウォーターマーク。キーは直近 FILL_KEY_DAYS 日分だけ残す"""
+    if len(df_hist) == 0: return watermark
+    last, first = df_hist['trade_date'].max(), df_hist['trade_date'].min()
+    since = last - timedelta(days=FILL_KEY_DAYS)
+    if watermark:
+        last = max(last, pd.Timestamp(watermark['date']))
+        since = max(last - timedelta(days=FILL_KEY_DAYS), pd.Timestamp(watermark['since']))
+        first = min(first, pd.Timestamp(watermark['first'])) if watermark['first'] else None
+    by_day = {d: set(ks) for d, ks in (watermark['keys'] if watermark else {}).items() if pd.Timestamp(d) >= since}
+    for d, k in zip(df_hist['trade_date'], keys):
+        if d >= since: by_day.setdefault(fmt_date(d), set()).add(k)
+    return {'first': fmt_date(first), 'date': fmt_date(last), 'since': fmt_date(since),
+            'keys': {d: sorted(ks) for d, ks in sorted(by_day.items())}}
+
+def market_watermarks(watermark, state):
+    """市場ごとのウォーターマーク（旧形式の全体1つは、保有状態にある市場のものとして読む）"""
+    if not watermark: return {}
+    if 'markets' in watermark: return {m: _norm_watermark(w) for m, w in watermark['markets'].items()}
+    return {m: _norm_watermark(watermark) for m in pd.unique(state['market'])}
+
+def apply_history(state, df_hist, watermark):
+    """取引履歴のうち未反映の約定だけを市場ごとに保有状態へ反映し (状態, ウォーターマーク) を返す。
+    反映済みの最終日より前に未反映の約定がある市場は、履歴が最初の約定まで遡っていればその市場だけ
+    計算し直し、遡っていなければ ValueError"""
+    wms = market_watermarks(watermark, state)
+    for market, h in df_hist[df_hist['trade_date'].notna()].groupby('market', sort=False, observed=True):
+        keys, wm = fill_keys(h), wms.get(market)
+        new = unapplied_fills(h, keys, wm)
+        if wm and (h.loc[new, 'trade_date'] < pd.Timestamp(wm['date'])).any():
+            if not wm['first'] or h['trade_date'].min() > pd.Timestamp(wm['first']):
+                raise ValueError(f"{market}: 反映済みの期間に未反映の約定があります。最初の約定"
+                                 f"（{wm['first'] or '不明'}）から含む履歴を取込むか、保有状態をリセットしてください")
+            state, wm, new = state[state['market'] != market], None, pd.Series(True, index=h.index)
+        state = apply_fills(state, h[new])
+        wms[market] = next_watermark(h[new], keys[new], wm)
+    return state, {'markets': {m: w for m, w in wms.items() if w}}
+
+# ==================== 取引キー ====================
+# 重複判定に使う列（同一銘柄・同日でも数量・価格・損益が違えば別取引）
+TRADE_KEY_COLS = ['market', 'ticker', 'trade_date', 'build_date',
+                  'quantity', 'sell_price', 'avg_cost', 'realized_pl']
+
+def trade_keys(df):
+    """取引内容のハッシュ（完全に同内容の取引は出現順の連番で区別）"""
+    canon = pd.DataFrame({
+        'market': df['market'].astype(str), 'ticker': df['ticker'].astype(str),
+        **{c: pd.to_datetime(df[c], errors='coerce').dt.strftime('%Y-%m-%d').fillna('')
+           for c in ['trade_date', 'build_date']},
+        **{c: pd.to_numeric(df[c], errors='coerce').astype(float).round(4).astype(str)
+           for c in ['quantity', 'sell_price', 'avg_cost', 'realized_pl']},
+    })
+    h = pd.Series(pd.util.hash_pandas_object(canon, index=False).to_numpy(), index=df.index).map('{:016x}'.format)
+    return h + '#' + h.groupby(h).cumcount().astype(str)
+
+def _fill_trade_keys(df):
+    # trade_key 列導入前の行はその場で計算
+    missing = df['trade_key'].isna() | (df['trade_key'] == '')
+    if missing.any():
+        df.loc[missing, 'trade_key'] = trade_keys(df)[missing]
+    return df
+
+# ==================== Trade_Log キャッシュ ====================
+def _to_text(s):
+    return s.map(lambda v: str(int(v)) if isinstance(v, float) and v.is_integer() else str(v))
+
+def _to_datetime(s):
+    # 文字列（ISO）とシート上のシリアル値が混在しうる
+    serial = pd.to_numeric(s, errors='coerce')
+    dt = pd.to_datetime(s.astype(str), format='ISO8601', errors='coerce')
+    return dt.fillna(pd.to_datetime(serial, unit='D', origin='1899-12-30', errors='coerce'))
+
+def apply_tradelog_schema(df):
+    """TRADELOG_SCHEMA に従って型付け（同期時に1回だけ）"""
+    for col in df.columns:
+        kind = TRADELOG_SCHEMA.get(col)
+        if kind is None:
+            df[col] = _to_text(df[col])
+        elif kind == 'category':
+            df[col] = _to_text(df[col]).astype('category')
+        elif kind == 'datetime':
+            df[col] = _to_datetime(df[col])
+        else:
+            num = pd.to_numeric(df[col], errors='coerce')
+            if col in TRADELOG_FILL: num = num.fillna(TRADELOG_FILL[col])
+            if kind.startswith('Int'):
+                num = num.round()
+                num = num.where(num.abs() <= np.iinfo(kind.lower()).max)  # 型に収まらない値は空欄扱い
+            df[col] = num.astype(kind)
+    return df
+
+def _normalize_tradelog(df):
     # 旧カラム互換（tag_detail → tag_medium へ移行）
     if 'tag_detail' in df.columns and 'tag_medium' not in df.columns:
         df = df.rename(columns={'tag_detail': 'tag_medium'})
     for col in TRADELOG_COLS:
         if col not in df.columns:
             df[col] = ''
+    return apply_tradelog_schema(df)
+
+def _mirror_paths(store_key):
+    base = os.path.join(MIRROR_DIR, f"tradelog_{store_key}")
+    return base + '.parquet', base + '.json'
+
+def load_mirror(store_key):
+    if not PARQUET_AVAILABLE: return None
+    pq_path, meta_path = _mirror_paths(store_key)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('schema') != MIRROR_SCHEMA_VERSION or meta.get('cols') != TRADELOG_COLS:
+            return None
+        df = pd.read_parquet(pq_path)
+        if len(df) != meta['rows']: return None
+        return meta, df
+    except Exception:
+        return None
+
+def save_mirror(store_key, state):
+    if not PARQUET_AVAILABLE: return
+    pq_path, meta_path = _mirror_paths(store_key)
+    meta = {'schema': MIRROR_SCHEMA_VERSION, 'cols': TRADELOG_COLS,
+            'header': state['header'], 'rows': state['rows'], 'last': state['last']}
+    try:
+        os.makedirs(MIRROR_DIR, exist_ok=True)
+        state['df'].to_parquet(pq_path + '.tmp', index=False)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(pq_path + '.tmp', pq_path)
+        os.replace(meta_path + '.tmp', meta_path)
+    except Exception:
+        pass
+
+# 最後の同期からこの秒数が過ぎたら、手元の df を返しつつ裏で再同期
+TRADELOG_REFRESH_SEC = 300
+
+@st.cache_resource
+def _tradelog_sync_state(store_key):
+    """プロセス共有の差分同期状態（rows = 読込済みデータ行数のウォーターマーク,
+    version = df が変わるたびに振り直すデータ版, synced_at = 最後に保存先と照合した時刻。0 = 未照合）"""
+    state = {'lock': threading.Lock(), 'header': None, 'rows': 0, 'last': None, 'df': None,
+             'synced_at': 0, 'bg': None, 'key_index': None, 'row_index': {}, 'version': None}
+    mirror = load_mirror(store_key)
+    if mirror:
+        meta, df = mirror
+        state.update(header=meta['header'], rows=meta['rows'], last=meta['last'], df=df,
+                     version=os.urandom(8).hex())
+    return state
+
+def _sync_full(store, state):
+    header, body = store.read_rows(TRADELOG_SHEET)
+    state.update(header=header, rows=len(body), last=_trim_row(body[-1]) if body else None,
+                 df=_fill_trade_keys(_normalize_tradelog(_rows_to_frame(header, body))), key_index=None, row_index={},
+                 version=os.urandom(8).hex())
+    save_mirror(store.key, state)
+
+def sync_tradelog(store, full=False):
+    """前回読んだ行の続きだけ取得してマージ。書き換えを検知したら全件再読込"""
+    state = _tradelog_sync_state(store.key)
+    with state['lock']:
+        if full or state['df'] is None:
+            _sync_full(store, state)
+        else:
+            n = state['rows']
+            # 最終既知行から1行重ねて取得し、その行が変わっていないかで書き換えを検知
+            header, tail = store.read_rows(TRADELOG_SHEET, max(n - 1, 0))
+            if header != state['header'] or (n > 0 and (not tail or _trim_row(tail[0]) != state['last'])):
+                _sync_full(store, state)
+            else:
+                if n > 0: tail = tail[1:]
+                if tail:
+                    _merge_tail(state, header, tail)
+                    save_mirror(store.key, state)
+        state['synced_at'] = time.time()
+        return state['df']
+
+def _merge_tail(state, header, tail):
+    # 末尾に増えた行を型付けして連結し、ウォーターマークとデータ版を進める
+    new_df = _normalize_tradelog(_rows_to_frame(header, tail))
+    df = pd.concat([state['df'], new_df], ignore_index=True)
+    for col in df.columns:
+        if TRADELOG_SCHEMA.get(col) == 'category':
+            df[col] = df[col].astype(str).astype('category')
+    state['df'] = _fill_trade_keys(df); state['key_index'] = None; state['row_index'] = {}
+    state['version'] = os.urandom(8).hex()
+    state['rows'] += len(tail); state['last'] = _trim_row(tail[-1])
+
+def tradelog_key_index(store_key):
+    """登録済み trade_key のハッシュ索引（データ更新まで使い回す）"""
+    state = _tradelog_sync_state(store_key)
+    with state['lock']:
+        if state['key_index'] is None:
+            df = state['df']
+            state['key_index'] = pd.Index(df['trade_key'] if df is not None else [], dtype=object).unique()
+        return state['key_index']
+
+def _row_index(state, key):
+    if key not in state['row_index']:
+        keys = state['df'][key].astype(str) if state['df'] is not None else pd.Series([], dtype=str)
+        uniq = ~keys.duplicated(keep=False).to_numpy()
+        state['row_index'][key] = pd.Series(np.arange(len(keys))[uniq], index=keys.to_numpy()[uniq])
+    return state['row_index'][key]
+
+def tradelog_row_index(store_key, key='id'):
+    """key 列の値 → df 行位置（シート行 = 位置 + 2）。重複している値は曖昧なので含めない"""
+    state = _tradelog_sync_state(store_key)
+    with state['lock']:
+        return _row_index(state, key)
+
+def _start_background_sync(store_key, full=False):
+    """ストアとの同期を別スレッドで実行（専用のストアを使う。同時に1本だけ）"""
+    state = _tradelog_sync_state(store_key)
+    if state['bg'] is not None and state['bg'].is_alive():
+        if full: state['want_full'] = True  # 実行中の同期が終わったら続けて全件
+        return state['bg']
+    def run():
+        f = full
+        while True:
+            try:
+                store = build_storage()
+                if store: sync_tradelog(store, full=f)
+            except Exception:
+                pass
+            f = state.pop('want_full', False)
+            if not f: break
+    state['bg'] = threading.Thread(target=run, daemon=True)
+    state['bg'].start()
+    return state['bg']
+
+@st.cache_resource
+def warm_tradelog(store_key):
+    """プロセスで最初の実行時に1回だけ、裏で同期を始めておく"""
+    _start_background_sync(store_key)
+    return True
+
+def load_tradelog_cached(store_key):
+    """手元の df を即返す（stale-while-revalidate）。古ければ裏で再同期し、終われば version が進む。
+    同期を待つのはミラーもない初回だけ。戻り値は読み取り専用の共有データ"""
+    if not get_storage(): return pd.DataFrame(columns=TRADELOG_COLS)
+    state = _tradelog_sync_state(store_key)
+    if state['df'] is None:
+        _start_background_sync(store_key).join()
+    elif time.time() - state['synced_at'] >= TRADELOG_REFRESH_SEC:
+        _start_background_sync(store_key)
+    version, df = state['version'], state['df']
+    if df is None or len(df) == 0: return pd.DataFrame(columns=TRADELOG_COLS)
+    # 共有フレームをデータごと複製せずに渡す（浅いコピー + Copy-on-Write で呼び出し側の変更は共有側に及ばない）
+    df = df.copy(deep=False)
+    df.attrs['version'] = version  # 分析キャッシュのキー
     return df
 
-def reload_tradelog():
-    load_tradelog_cached.clear()
+def append_tradelog(store, df):
+    """Trade_Log へ追記し、書いた行をそのまま手元の同期状態へ取り込む（読み直さない）。
+    他所の追記が挟まっていたら裏の同期に任せる。書けた行数を返す（df の先頭から。途中で失敗すると len(df) 未満）"""
+    written = []
+    store.append(TRADELOG_SHEET, df, written=written)
+    n = sum(len(rows) for _, _, rows in written)
+    if n == 0: return 0
+    state = _tradelog_sync_state(store.key)
+    with state['lock']:
+        for start, header, rows in written:
+            if state['df'] is None or header != state['header'] or start != state['rows']:
+                state['synced_at'] = 0
+                break
+            _merge_tail(state, header, rows)
+        save_mirror(store.key, state)
+    if state['synced_at'] == 0: _start_background_sync(store.key)
+    return n
+
+def reload_tradelog(full=False):
+    """裏で再同期（full=True なら全件読み直し）。終わるまでは手元の df を返し続ける"""
+    store = get_storage()
+    if not store: return
+    _tradelog_sync_state(store.key)['synced_at'] = 0
+    _start_background_sync(store.key, full=full)
+
+def _col_letter(i):
+    s = ''
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+def _sheet_col(header, col):
+    # 旧カラム互換（tag_detail 列のシートには tag_medium をそこへ書く）
+    return 'tag_detail' if col == 'tag_medium' and 'tag_medium' not in header and 'tag_detail' in header else col
+
+def _patch_tradelog(state, pos, updates):
+    # 書き込んだセルを手元の df・データ版へ反映（全件は読み直さない）
+    df = state['df'].copy()
+    for col in updates.columns:
+        m = updates[col].notna().to_numpy()
+        if not m.any(): continue
+        s = df[col].astype(object)
+        s.iloc[pos[m]] = updates[col].to_numpy()[m]
+        df[col] = apply_tradelog_schema(pd.DataFrame({col: s}))[col]
+    state['df'] = df
+    state['version'] = os.urandom(8).hex()
+
+def update_tradelog_cells(store, updates, key='trade_key'):
+    """updates（index = key 列の値, 値 = 文字列）のうち NaN でないセルだけを1回の書き込みで書き換える。
+    戻り値は更新できなかった行数（key が見つからない・重複）。失敗時は None"""
+    if len(updates) == 0: return 0
+    try:
+        sync_tradelog(store)
+        state = _tradelog_sync_state(store.key)
+        with state['lock']:
+            header = state['header']
+            pos = _row_index(state, key).reindex(updates.index.astype(str)).to_numpy()
+            found = ~np.isnan(pos)
+            updates, pos = updates[found], pos[found].astype(int)
+            cols = sorted((c for c in updates.columns if _sheet_col(header, c) in header),
+                          key=lambda c: header.index(_sheet_col(header, c)))
+            updates = updates[cols]
+            if store.update_cells(TRADELOG_SHEET, header, key, pos, updates):
+                _patch_tradelog(state, pos, updates)
+                if state['rows'] - 1 in pos:  # 最終行を書き換えたら書き換え検知用の行も読み直す
+                    state['last'] = _trim_row((store.read_rows(TRADELOG_SHEET, state['rows'] - 1)[1] or [[]])[0])
+                save_mirror(store.key, state)
+        return int((~found).sum())
+    except Exception as e:
+        st.error(f"更新エラー: {e}"); return None
+
+# ==================== 保有状態（Positions）====================
+def read_settings(store):
+    df = store.read(SETTINGS_SHEET)
+    if len(df) == 0 or 'key' not in df.columns: return {}
+    return dict(zip(df['key'], df['value']))
+
+def write_settings(store, values):
+    cur = read_settings(store); cur.update(values)
+    return store.write(SETTINGS_SHEET, pd.DataFrame({'key': list(cur), 'value': list(cur.values())}))
+
+@st.cache_data(ttl=300)
+def load_position_state_cached(store_key):
+    """Positionsシートの保有状態と、最後に反映した約定のウォーターマーク"""
+    store = get_storage()
+    if not store: return empty_position_state(), None
+    df = store.read(POSITIONS_SHEET)
+    if len(df) == 0 or not set(POSITIONS_COLS) <= set(df.columns):
+        state = empty_position_state()
+    else:
+        state = df[POSITIONS_COLS].copy()
+        for col in ['quantity', 'held']:
+            state[col] = pd.to_numeric(state[col], errors='coerce').fillna(0).astype(int)
+        state['avg_price'] = pd.to_numeric(state['avg_price'], errors='coerce').fillna(0.0)
+    wm = read_settings(store).get('positions_watermark')
+    try: wm = json.loads(wm) if wm else None
+    except ValueError: wm = None
+    return state, wm
+
+def save_position_state(store, state, watermark):
+    ok = store.write(POSITIONS_SHEET, state) and \
+        write_settings(store, {'positions_watermark': json.dumps(watermark, ensure_ascii=False)})
+    load_position_state_cached.clear()
+    return ok
+
+# ==================== 株価 ====================
+# 株価キャッシュの有効期間（全セッション共有）と、個別取得の並列数
+PRICE_TTL_SEC = 15 * 60
+PRICE_WORKERS = 8
+# 取得に失敗した銘柄は、この秒数は取り直さない（失敗し続ける銘柄で毎回の再実行を待たせない）
+PRICE_FAIL_TTL_SEC = 60
+# 日足OHLCのローカル保存先（銘柄ごとのParquet）と、初回取得でさかのぼる日数
+PRICE_HISTORY_DIR = os.environ.get("PRICE_HISTORY_DIR", ".price_history")
+PRICE_HISTORY_DAYS = 730
+OHLC_COLS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+def price_symbol(ticker, market):
+    return f"{ticker}.T" if market == '日本株' else str(ticker)
+
+class YFinanceProvider:
+    """株価プロバイダ。fetch(symbols) -> {symbol: 終値}（取れなかった銘柄は含めない）"""
+    def fetch(self, symbols):
+        out = {}
+        try:
+            data = yf.download(symbols, period='5d', group_by='ticker', progress=False, auto_adjust=False)
+            for s in symbols:
+                try:
+                    close = (data[s]['Close'] if isinstance(data.columns, pd.MultiIndex) else data['Close']).dropna()
+                    if len(close): out[s] = float(close.iloc[-1])
+                except KeyError:
+                    pass
+        except Exception:
+            pass
+        # 一括で取れなかった銘柄だけ個別に（他銘柄の失敗には影響されない）
+        rest = [s for s in symbols if s not in out]
+        if rest:
+            with ThreadPoolExecutor(max_workers=min(PRICE_WORKERS, len(rest))) as ex:
+                for s, p in zip(rest, ex.map(self._fetch_one, rest)):
+                    if p is not None: out[s] = p
+        return out
+
+    def history(self, symbols, start):
+        """start 以降の日足 -> {symbol: OHLC DataFrame}"""
+        data = yf.download(symbols, start=start.strftime('%Y-%m-%d'), group_by='ticker',
+                           progress=False, auto_adjust=False)
+        out = {}
+        for s in symbols:
+            try: df = data[s] if isinstance(data.columns, pd.MultiIndex) else data
+            except KeyError: continue
+            df = df.dropna(subset=['Close'])
+            if len(df): out[s] = df
+        return out
+
+    def earnings(self, symbols, limit=24):
+        """決算発表日 -> DataFrame(symbol, date)（取れなかった銘柄は含めない）"""
+        def one(s):
+            try: idx = pd.DatetimeIndex(yf.Ticker(s).get_earnings_dates(limit=limit).index)
+            except Exception: return []
+            return list((idx.tz_localize(None) if idx.tz is not None else idx).normalize())
+        with ThreadPoolExecutor(max_workers=min(PRICE_WORKERS, len(symbols))) as ex:
+            got = list(ex.map(one, symbols))
+        return pd.DataFrame({'symbol': np.repeat(symbols, [len(g) for g in got]),
+                             'date': pd.DatetimeIndex([d for g in got for d in g])})
+
+    def _fetch_one(self, symbol):
+        try:
+            hist = yf.Ticker(symbol).history(period='5d')
+            return float(hist['Close'].dropna().iloc[-1]) if len(hist) > 0 else None
+        except Exception:
+            return None
+
+class PriceService:
+    """TTL付きの株価キャッシュ。取得失敗時は古い値があればそれを返す"""
+    def __init__(self, provider, ttl=PRICE_TTL_SEC, fail_ttl=PRICE_FAIL_TTL_SEC):
+        self.provider = provider; self.ttl = ttl; self.fail_ttl = fail_ttl
+        self._cache = {}    # symbol -> (price, fetched_at)
+        self._failed = {}   # symbol -> 最後に取得に失敗した時刻
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def peek(self, symbols):
+        """ネットワークに出ずキャッシュ済みの値だけ返す"""
+        with self._lock:
+            return {s: self._cache[s][0] for s in symbols if s in self._cache}
+
+    def fetched_at(self, symbols):
+        with self._lock:
+            ts = [self._cache[s][1] for s in symbols if s in self._cache]
+        return min(ts) if ts else None
+
+    def _stale(self, symbols):
+        now = time.time()
+        with self._lock:
+            return [s for s in symbols if (s not in self._cache or now - self._cache[s][1] >= self.ttl)
+                    and now - self._failed.get(s, -self.fail_ttl) >= self.fail_ttl]
+
+    def quotes(self, symbols):
+        symbols = list(dict.fromkeys(symbols))
+        if self._stale(symbols):
+            # 取得は同時に1本（他セッションは待ってからキャッシュを使う）
+            with self._fetch_lock:
+                stale = self._stale(symbols)
+                if stale:
+                    try: got = self.provider.fetch(stale)
+                    except Exception: got = {}
+                    now = time.time()
+                    with self._lock:
+                        for s in stale:
+                            if s in got: self._cache[s] = (got[s], now); self._failed.pop(s, None)
+                            else: self._failed[s] = now
+        return self.peek(symbols)
+
+class PriceHistoryStore:
+    """銘柄ごとの日足をディスクに保持し、足りない期間だけ provider から取得して追記"""
+    def __init__(self, provider, root=PRICE_HISTORY_DIR):
+        self.provider = provider; self.root = root
+        self._frames = {}; self._updated = {}
+        self._lock = threading.Lock()
+
+    def _path(self, symbol):
+        return os.path.join(self.root, f"{symbol.replace(os.sep, '_')}.parquet")
+
+    def load(self, symbol):
+        with self._lock:
+            if symbol not in self._frames:
+                try: df = pd.read_parquet(self._path(symbol))
+                except Exception: df = pd.DataFrame(columns=OHLC_COLS, index=pd.DatetimeIndex([], name='Date'))
+                self._frames[symbol] = df
+            return self._frames[symbol]
+
+    def last_close(self, symbols):
+        """ローカルの最終終値（ネットワーク不要）"""
+        out = {}
+        for s in symbols:
+            df = self.load(s)
+            if len(df): out[s] = float(df['Close'].iloc[-1])
+        return out
+
+    def update(self, symbols, days=PRICE_HISTORY_DAYS):
+        """保存済み最終日以降だけ取得（最終日は確定値で上書き）。開始日が同じ銘柄は1リクエストにまとめる"""
+        if self.provider is None: return
+        now = time.time()
+        today = pd.Timestamp(date.today())
+        by_start = {}
+        for s in symbols:
+            if now - self._updated.get(s, 0) < PRICE_TTL_SEC: continue
+            df = self.load(s)
+            start = df.index.max() if len(df) else today - pd.Timedelta(days=days)
+            by_start.setdefault(start, []).append(s)
+        for start, syms in by_start.items():
+            try: got = self.provider.history(syms, start)
+            except Exception: continue
+            for s in syms:
+                if s in got: self._append(s, got[s])
+                self._updated[s] = now
+
+    def _append(self, symbol, new):
+        new = new[OHLC_COLS].astype(float)
+        idx = pd.DatetimeIndex(new.index)
+        new.index = (idx.tz_localize(None) if idx.tz is not None else idx).normalize().rename('Date')
+        with self._lock:
+            df = pd.concat([self._frames.get(symbol), new]) if len(self._frames.get(symbol, [])) else new
+            df = df[~df.index.duplicated(keep='last')].sort_index()
+            self._frames[symbol] = df
+            if not PARQUET_AVAILABLE: return
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                path = self._path(symbol)
+                df.to_parquet(path + '.tmp'); os.replace(path + '.tmp', path)
+            except Exception:
+                pass
+
+# PRICE_PROVIDER（既定 yfinance）で選ぶ株価プロバイダ。fetch / history / earnings を持つクラスを登録する
+PRICE_PROVIDERS = {'yfinance': YFinanceProvider}
+
+def get_price_provider():
+    """設定されたプロバイダ（yfinance 未インストールなど使えなければ None）"""
+    name = os.environ.get("PRICE_PROVIDER", "yfinance").strip().lower()
+    if name == 'yfinance' and not YFINANCE_AVAILABLE: return None
+    factory = PRICE_PROVIDERS.get(name)
+    return factory() if factory else None
+
+@st.cache_resource
+def get_price_history_store():
+    return PriceHistoryStore(get_price_provider())
+
+@st.cache_resource
+def get_price_service():
+    provider = get_price_provider()
+    return PriceService(provider) if provider else None
+
+@st.cache_data(ttl=24 * 3600, show_spinner=False)
+def load_earnings_dates(symbols):
+    provider = get_price_provider()
+    if provider is None or not symbols: return pd.DataFrame({'symbol': [], 'date': pd.DatetimeIndex([])})
+    return provider.earnings(list(symbols))
 
 # ==================== セッションステート ====================
 def init_state():
@@ -489,8 +1457,11 @@ def init_state():
         'realized_df': None,
         'history_df': None,
         'pending': [],
+        'pending_rows': None,
         'tag_state': {},
         'positions': None,
+        'auto_rules': [],
+        'auto_proposals': None,
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -498,32 +1469,297 @@ def init_state():
 
 init_state()
 
-sheets_client = get_sheets_client()
-sid = get_sid()
-if sheets_client and sid:
-    init_sheets(sheets_client, sid)
+store = get_storage()
+if store:
+    try:
+        bootstrap_storage(store.key)
+        warm_tradelog(store.key)
+    except Exception as e: st.error(f"{store.label}初期化エラー: {e}")
 
 # ==================== ユーティリティ ====================
 def hex_to_rgb(h):
     h = h.lstrip('#')
     return ','.join(str(int(h[i:i+2],16)) for i in (0,2,4))
 
-def is_new_trade(trade_date_str):
-    """今日以降の取引かどうか"""
-    try:
-        td = datetime.strptime(str(trade_date_str)[:10], '%Y-%m-%d').date()
-        return td >= TODAY
-    except:
-        return False
+# セッションに置く表でカテゴリ型にする列（銘柄・名前・タグは繰り返しが多い）
+COMPACT_CATEGORY_COLS = ('market', 'ticker', 'name', 'tag_large', 'tag_medium', 'tag_small')
+
+def compact_frame(df):
+    """セッションに置く前に型を詰める（値は変えない）。
+    COMPACT_CATEGORY_COLS は category、整数は入る最小の整数型、float は float32 で同じ値になる列だけ float32"""
+    out = {}
+    for col, s in df.items():
+        if col in COMPACT_CATEGORY_COLS and not isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype('category')
+        elif pd.api.types.is_integer_dtype(s):
+            s = pd.to_numeric(s, downcast='integer')
+        elif pd.api.types.is_float_dtype(s):
+            f32 = s.astype(np.float32)
+            if np.array_equal(f32.to_numpy(dtype=float), s.to_numpy(dtype=float), equal_nan=True): s = f32
+        out[col] = s
+    return pd.DataFrame(out, index=df.index)
+
+def build_trade_rows(realized, today=None):
+    """実現損益 → Trade_Log 行（hold_days・id・created_at を列単位で計算）。
+    (今日より前 = タグなしで即保存, 今日以降 = タグ付け待ち) の2つを返す"""
+    today = pd.Timestamp(today or TODAY)
+    td = pd.to_datetime(realized['trade_date'], errors='coerce')
+    bd = pd.to_datetime(realized['build_date'], errors='coerce')
+    n = len(realized)
+    rows = pd.DataFrame({
+        'id': np.char.mod('%08x', np.frombuffer(os.urandom(4 * n), dtype=np.uint32)) if n else [],
+        'market': realized['market'], 'ticker': realized['ticker'], 'name': realized['name'],
+        'trade_date': td.dt.strftime('%Y-%m-%d').fillna(''),
+        'build_date': bd.dt.strftime('%Y-%m-%d').fillna(''),
+        'quantity': realized['quantity'], 'sell_price': realized['sell_price'],
+        'avg_cost': realized['avg_cost'], 'realized_pl': realized['realized_pl'],
+        'realized_pl_pct': realized['realized_pl_pct'],
+        'hold_days': (td - bd).dt.days.astype('Int64').astype('string').fillna(''),
+        'tag_large': '', 'tag_medium': '', 'tag_small': '',
+        'satisfaction': '', 'stop_loss_price': '', 'discipline': '0', 'memo': '',
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'trade_key': realized['trade_key'],
+    }, index=realized.index)
+    is_new = (td >= today).to_numpy()
+    return rows[~is_new], rows[is_new]
+
+# ==================== 分析キューブ ====================
+PERIOD_DAYS = {"全期間": None, "過去1年": 365, "過去1ヶ月": 30, "期間指定": None}
+WEEKDAY_JP = ['月','火','水','木','金']
+
+def _with_flags(df):
+    # 勝ち・利益・損失を列にしておき、集計は組込みの名前付き集計だけで済ませる
+    pl = df['realized_pl']
+    return df.assign(_win=(pl > 0).astype(float) * 100, _pos=pl.where(pl > 0), _neg=pl.where(pl < 0))
+
+def _win_stats(g, **extra):
+    return g.agg(件数=('realized_pl','count'), 勝率=('_win','mean'), 総損益=('realized_pl','sum'), **extra)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def sorted_tradelog(version, _df):
+    """trade_date 昇順の共有フレーム（データ版ごとに1回だけ並べ替え。読み取り専用）"""
+    df = _df.dropna(subset=['trade_date'])
+    return df.iloc[np.argsort(df['trade_date'].to_numpy(), kind='stable')].reset_index(drop=True)
+
+def date_bounds(df_sorted, start=None, end=None):
+    """ソート済みフレームで期間に入る行の範囲 [i, j) を二分探索で求める（end の当日を含む）"""
+    dates = df_sorted['trade_date']
+    i = 0 if start is None else dates.searchsorted(pd.Timestamp(start), 'left')
+    j = len(dates) if end is None else dates.searchsorted(pd.Timestamp(end) + timedelta(days=1), 'left')
+    return int(i), int(j)
+
+def date_slice(df_sorted, start=None, end=None):
+    """ソート済みフレームを二分探索で切り出す（コピーしない）"""
+    i, j = date_bounds(df_sorted, start, end)
+    return df_sorted.iloc[i:j]
+
+def _finish_cube(kpi, daily, ticker_stats, wday, tag_stats, med_stats, hold_days):
+    # 集計エンジンによらず共通の整形（丸め・並べ替え・表示列）
+    avg_win, avg_loss = kpi.pop('avg_win'), kpi.pop('avg_loss')
+    avg_win  = avg_win if kpi['wins'] > 0 else 0
+    avg_loss = abs(avg_loss) if kpi['losses'] > 0 else 1
+    n = kpi['total_trades']
+    kpi.update(win_rate=kpi['wins'] / n * 100 if n > 0 else 0, pf=avg_win / avg_loss if avg_loss > 0 else 0)
+
+    daily = pd.DataFrame({'date': daily.index, 'daily_pl': daily.to_numpy(), 'cumulative': daily.cumsum().to_numpy(),
+                          'color': np.where(daily.to_numpy() >= 0, '#ef5350', '#42a5f5')})
+
+    ticker_stats['平均利益'] = ticker_stats['平均利益'].fillna(0).round(0)
+    ticker_stats['平均損失'] = ticker_stats['平均損失'].abs().fillna(0).round(0)
+    ticker_stats = ticker_stats.round(1).sort_values('総損益', ascending=False).reset_index()
+    ticker_stats['総損益']  = ticker_stats['総損益'].astype(int)
+    ticker_stats['平均損益'] = ticker_stats['平均損益'].round(0).astype(int)
+
+    wday = wday[wday.index < 5].round({'勝率': 1})
+    wday.insert(0, '曜日', [WEEKDAY_JP[d] for d in wday.index])
+
+    tag_stats = tag_stats.round(1).sort_values('総損益', ascending=False).reset_index()
+    tag_stats['総損益'] = tag_stats['総損益'].astype(int)
+
+    med_stats = med_stats.round({'勝率': 1}).reset_index()
+    med_stats['総損益'] = med_stats['総損益'].astype(int)
+    med_stats['ラベル'] = med_stats['tag_large'].astype(str) + '/' + med_stats['tag_medium'].astype(str)
+
+    return {'kpi': kpi, 'daily': daily, 'ticker_stats': ticker_stats, 'wday': wday,
+            'tag_stats': tag_stats, 'med_stats': med_stats, 'hold_days': hold_days}
+
+def _cube_pandas(df_sorted, start, end):
+    df = _with_flags(date_slice(df_sorted, start, end))
+    pl = df['realized_pl']
+    tagged_mask = df['tag_large'].astype(str).str.strip() != ''
+    kpi = {'total_pl': pl.sum(), 'total_trades': len(df), 'wins': int((pl > 0).sum()), 'losses': int((pl < 0).sum()),
+           'avg_win': df['_pos'].mean(), 'avg_loss': df['_neg'].mean(), 'tagged_cnt': int(tagged_mask.sum())}
+    daily = pl.groupby(df['trade_date'].dt.normalize()).sum().sort_index()
+    ticker_stats = df.groupby('ticker', observed=True).agg(
+        名前=('name','last'), 取引数=('realized_pl','count'), 勝率=('_win','mean'),
+        総損益=('realized_pl','sum'), 平均損益=('realized_pl','mean'),
+        平均利益=('_pos','mean'), 平均損失=('_neg','mean'), 平均保有日=('hold_days','mean'),
+    )
+    wday = _win_stats(df.groupby(df['trade_date'].dt.dayofweek))
+    tagged = df[tagged_mask]
+    tag_stats = _win_stats(tagged.groupby('tag_large', observed=True),
+                           平均損益=('realized_pl','mean'), 平均納得度=('satisfaction','mean'))
+    med = tagged[tagged['tag_medium'].astype(str).str.strip() != '']
+    med_stats = _win_stats(med.groupby(['tag_large','tag_medium'], observed=True))
+    return kpi, daily, ticker_stats, wday, tag_stats, med_stats, df['hold_days'].dropna().astype(float)
+
+# DuckDB に渡す列（_i = trade_date 昇順の並び位置。「最後の銘柄名」に使う）
+CUBE_SQL_COLS = ['trade_date', 'ticker', 'name', 'realized_pl', 'hold_days', 'tag_large', 'tag_medium', 'satisfaction']
+CUBE_SQL = {
+    'kpi': """SELECT sum(realized_pl) AS total_pl, count(*) AS total_trades,
+                     count(*) FILTER (realized_pl > 0) AS wins, count(*) FILTER (realized_pl < 0) AS losses,
+                     avg(realized_pl) FILTER (realized_pl > 0) AS avg_win, avg(realized_pl) FILTER (realized_pl < 0) AS avg_loss,
+                     count(*) FILTER (trim(tag_large) <> '') AS tagged_cnt FROM t""",
+    'daily': """SELECT date_trunc('day', trade_date) AS d, sum(realized_pl) AS pl FROM t GROUP BY d ORDER BY d""",
+    'ticker_stats': """SELECT ticker, arg_max(name, _i) AS 名前, count(realized_pl) AS 取引数,
+                              avg(CASE WHEN realized_pl > 0 THEN 100.0 ELSE 0.0 END) AS 勝率,
+                              sum(realized_pl) AS 総損益, avg(realized_pl) AS 平均損益,
+                              avg(realized_pl) FILTER (realized_pl > 0) AS 平均利益,
+                              avg(realized_pl) FILTER (realized_pl < 0) AS 平均損失,
+                              avg(hold_days) AS 平均保有日
+                       FROM t GROUP BY ticker ORDER BY ticker""",
+    'wday': """SELECT isodow(trade_date) - 1 AS dow, count(realized_pl) AS 件数,
+                      avg(CASE WHEN realized_pl > 0 THEN 100.0 ELSE 0.0 END) AS 勝率, sum(realized_pl) AS 総損益
+               FROM t GROUP BY dow ORDER BY dow""",
+    'tag_stats': """SELECT tag_large, count(realized_pl) AS 件数,
+                           avg(CASE WHEN realized_pl > 0 THEN 100.0 ELSE 0.0 END) AS 勝率, sum(realized_pl) AS 総損益,
+                           avg(realized_pl) AS 平均損益, avg(satisfaction) AS 平均納得度
+                    FROM t WHERE trim(tag_large) <> '' GROUP BY tag_large ORDER BY tag_large""",
+    'med_stats': """SELECT tag_large, tag_medium, count(realized_pl) AS 件数,
+                           avg(CASE WHEN realized_pl > 0 THEN 100.0 ELSE 0.0 END) AS 勝率, sum(realized_pl) AS 総損益
+                    FROM t WHERE trim(tag_large) <> '' AND trim(tag_medium) <> ''
+                    GROUP BY tag_large, tag_medium ORDER BY tag_large, tag_medium""",
+    'hold_days': """SELECT CAST(hold_days AS DOUBLE) AS hold_days FROM t WHERE hold_days IS NOT NULL""",
+}
+
+@st.cache_resource
+def duckdb_conn():
+    """プロセス共有のインメモリ DuckDB（集計ごとに cursor() で別接続を切り出す）"""
+    return duckdb.connect()
+
+def _arrow_table(df_sorted):
+    return pyarrow.Table.from_pandas(df_sorted[CUBE_SQL_COLS].assign(_i=np.arange(len(df_sorted))), preserve_index=False)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def tradelog_arrow(version, _df):
+    """sorted_tradelog の集計用 Arrow 表（データ版ごとに1回だけ変換。読み取り専用）"""
+    return _arrow_table(_df)
+
+def _cube_sql(table, i, j):
+    # 期間は trade_date 昇順の行範囲 [i, j) なので、その範囲だけを（コピーせず）切り出して渡す
+    with duckdb_conn().cursor() as con:
+        con.register('t', table.slice(i, j - i))
+        q = {k: con.execute(sql).df() for k, sql in CUBE_SQL.items()}
+    kpi = q['kpi'].iloc[0].to_dict()
+    kpi.update(total_pl=0.0 if pd.isna(kpi['total_pl']) else kpi['total_pl'], total_trades=int(kpi['total_trades']), wins=int(kpi['wins']),
+               losses=int(kpi['losses']), tagged_cnt=int(kpi['tagged_cnt']))
+    daily = q['daily'].set_index('d')['pl'].rename_axis('trade_date').rename('realized_pl')
+    return (kpi, daily, q['ticker_stats'].set_index('ticker'), q['wday'].set_index('dow').rename_axis('trade_date'),
+            q['tag_stats'].set_index('tag_large'), q['med_stats'].set_index(['tag_large', 'tag_medium']),
+            q['hold_days']['hold_days'])
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def analytics_cube(version, start, end, _df, _store=None):
+    """ダッシュボードの集計一式（データ版 × 期間ごとにキャッシュ）。_df は sorted_tradelog の結果。
+    DuckDB があれば SQL で、無ければ pandas で集計する。_store が索引で期間を読める保存先（SQLite）なら、
+    期間指定時はその期間の行だけを保存先から読んで集計する"""
+    if _store is not None and _store.indexed_range and (start is not None or end is not None):
+        df = _store.read_range(start, end)
+        parts = _cube_sql(_arrow_table(df), 0, len(df)) if DUCKDB_AVAILABLE else _cube_pandas(df, None, None)
+    elif DUCKDB_AVAILABLE:
+        parts = _cube_sql(tradelog_arrow(version, _df), *date_bounds(_df, start, end))
+    else:
+        parts = _cube_pandas(_df, start, end)
+    return _finish_cube(*parts)
+
+# ==================== 自動タグ付け ====================
+TAG_COLS = ['tag_large', 'tag_medium', 'tag_small']
+# 「大」「大 / 中」「大 / 中 / 小」の全パス（ルールの付与先）
+TAG_PATHS = [' / '.join(p) for l, ms in TAG_TREE.items()
+             for p in [(l,)] + [q for m, ss in ms.items() for q in [(l, m)] + [(l, m, x) for x in ss]]]
+PL_SIGNS = {'すべて': 0, '利益': 1, '損失': -1}
+EARNINGS_TAGS = {'after': ('イベント', '決算後初動', ''), 'before': ('イベント', '決算前先回り', '')}
+
+def tag_history(df_log):
+    """銘柄ごとに最も多く付けたタグ（大・中・小）"""
+    t = df_log.loc[df_log['tag_large'].astype(str).str.strip() != '', ['ticker'] + TAG_COLS].astype(str)
+    n = t.groupby(['ticker'] + TAG_COLS).size().rename('n').reset_index()
+    return n.sort_values(['ticker', 'n'], ascending=[True, False]).drop_duplicates('ticker').set_index('ticker')[TAG_COLS]
+
+def _band_mask(df, rule):
+    hold = pd.to_numeric(df['hold_days'], errors='coerce').to_numpy(dtype=float)
+    pl   = pd.to_numeric(df['realized_pl'], errors='coerce').to_numpy(dtype=float)
+    td   = pd.to_datetime(df['trade_date'], errors='coerce')
+    lo, hi = rule['hold']
+    hit = np.ones(len(df), bool)
+    if lo > 0:          hit &= hold >= lo
+    if hi is not None:  hit &= hold <= hi
+    if rule['pl']:      hit &= np.sign(pl) == rule['pl']
+    if rule.get('dates'):
+        d0, d1 = rule['dates']
+        hit &= ((td >= pd.Timestamp(d0)) & (td < pd.Timestamp(d1) + timedelta(days=1))).to_numpy()
+    return hit
+
+def _earnings_hits(df, earnings, days):
+    # 銘柄ごとに最も近い決算日（±days 以内）へ merge_asof
+    sym = np.where(df['market'].astype(str) == '日本株', df['ticker'].astype(str) + '.T', df['ticker'].astype(str))
+    left = pd.DataFrame({'symbol': sym, 'date': pd.to_datetime(df['trade_date'], errors='coerce').astype('datetime64[ns]'),
+                         'pos': np.arange(len(df))}).dropna(subset=['date']).sort_values('date')
+    right = earnings.assign(symbol=earnings['symbol'].astype(str), edate=earnings['date'].astype('datetime64[ns]'))
+    m = pd.merge_asof(left, right[['symbol', 'edate']].sort_values('edate'), left_on='date', right_on='edate',
+                      by='symbol', direction='nearest', tolerance=pd.Timedelta(days=days)).dropna(subset=['edate'])
+    vals = np.full((len(df), 3), '', dtype=object)
+    after = (m['date'] >= m['edate']).to_numpy()
+    vals[m['pos'].to_numpy()[after]]  = EARNINGS_TAGS['after']
+    vals[m['pos'].to_numpy()[~after]] = EARNINGS_TAGS['before']
+    return vals[:, 0] != '', vals
+
+def propose_tags(df, rules, history=None, earnings=None):
+    """rules を上から順に全行へ一括適用（先に当たったルールが優先）。
+    戻り値は df と同じ index の提案（tag_large/medium/small, rule）。当たらない行は rule が空"""
+    n = len(df)
+    vals = np.full((n, 3), '', dtype=object)
+    rule_of = np.full(n, '', dtype=object)
+    free = np.ones(n, bool)
+    for rule in rules:
+        if rule['kind'] == 'history':
+            if history is None or len(history) == 0: continue
+            got = history.reindex(df['ticker'].astype(str).to_numpy())
+            hit, rv = got['tag_large'].notna().to_numpy(), got.fillna('').to_numpy(dtype=object)
+        elif rule['kind'] == 'earnings':
+            if earnings is None or len(earnings) == 0: continue
+            hit, rv = _earnings_hits(df, earnings, rule['days'])
+        else:
+            hit = _band_mask(df, rule)
+            rv = np.array([(list(rule['tags']) + ['', ''])[:3]], dtype=object)
+        hit = hit & free
+        vals[hit] = rv[hit] if len(rv) == n else rv
+        rule_of[hit] = rule['name']
+        free &= ~hit
+    out = pd.DataFrame(vals, index=df.index, columns=TAG_COLS)
+    out['rule'] = rule_of
+    return out
 
 # ==================== メインUI ====================
-tab_import, tab_tag, tab_dash, tab_pos, tab_settings = st.tabs([
-    "📥 取込", "🏷 タグ付け", "📊 分析", "📦 保有", "⚙️ 設定"
-])
+TAB_LABELS = ["📥 取込", "🏷 タグ付け", "📊 分析", "📦 保有", "⚙️ 設定"]
+
+def main_tabs():
+    """選択中のタブだけ本体を実行できるよう状態付きタブを作る（未対応の版では通常のタブ）"""
+    try:
+        return st.tabs(TAB_LABELS, key='main_tab', on_change='rerun')
+    except TypeError:
+        return st.tabs(TAB_LABELS)
+
+def tab_open(tab):
+    # .open が None（状態なし）なら従来どおり常に実行
+    return getattr(tab, 'open', None) is not False
+
+tab_import, tab_tag, tab_dash, tab_pos, tab_settings = main_tabs()
 
 # ====================================================
 # TAB 1: 取込
 # ====================================================
+# 取込タブはアップロード中のファイルを保持するため常に実行（CSV解析は内容ハッシュでメモ化済み）
 with tab_import:
     st.markdown('<div class="section-title">実現損益CSV（分析の主軸）</div>', unsafe_allow_html=True)
     col1, col2 = st.columns(2)
@@ -551,8 +1787,8 @@ with tab_import:
     ]:
         if f:
             try:
-                df = read_csv_auto(f)
-                realized_parts.append(parser(df))
+                df = parse_upload(f, parser)
+                realized_parts.append(df)
                 st.success(f"{label}: {len(df)}件 ✅")
             except Exception as e:
                 st.error(f"{label} 読み込みエラー: {e}")
@@ -563,8 +1799,8 @@ with tab_import:
     ]:
         if f:
             try:
-                df = read_csv_auto(f)
-                history_parts.append(parser(df))
+                df = parse_upload(f, parser)
+                history_parts.append(df)
                 st.success(f"{label}: {len(df)}件 ✅")
             except Exception as e:
                 st.error(f"{label} 読み込みエラー: {e}")
@@ -575,7 +1811,7 @@ with tab_import:
         with col_btn:
             do_import = st.button("⚡ メモリに読み込む", type="primary", use_container_width=True)
         with col_info:
-            st.caption("✅ Sheets接続OK" if (sheets_client and sid) else "⚠️ Sheets未接続")
+            st.caption(f"✅ {store.label}接続OK" if store else "⚠️ 保存先未接続")
 
         if do_import:
             if realized_parts:
@@ -583,77 +1819,54 @@ with tab_import:
                 combined_r = combined_r.sort_values('trade_date', ascending=False).reset_index(drop=True)
 
                 # 既存ログと差分チェック
-                new_trades = []    # 今日以降 → タグ付け対象
-                old_trades = []    # 今日より前 → タグなし即保存対象
-
-                if sheets_client and sid:
-                    existing = load_tradelog_cached(sid)
-                    if len(existing) > 0 and 'ticker' in existing.columns:
-                        existing_keys = set(existing['ticker'].astype(str) + '_' + existing['trade_date'].astype(str))
-                        combined_r['_key'] = combined_r['ticker'].astype(str) + '_' + combined_r['trade_date'].astype(str)
-                        dup_cnt = (combined_r['_key'].isin(existing_keys)).sum()
-                        combined_r = combined_r[~combined_r['_key'].isin(existing_keys)].drop('_key', axis=1)
+                combined_r['trade_key'] = trade_keys(combined_r)
+                if store:
+                    load_tradelog_cached(store.key)
+                    existing_keys = tradelog_key_index(store.key)
+                    if len(existing_keys) > 0:
+                        is_dup = existing_keys.get_indexer(combined_r['trade_key']) >= 0
+                        dup_cnt = int(is_dup.sum())
+                        combined_r = combined_r[~is_dup]
                         if dup_cnt > 0:
                             st.info(f"既登録 {dup_cnt}件をスキップ → 新規 {len(combined_r)}件")
 
-                for _, row in combined_r.iterrows():
-                    item = {
-                        'idx': int(row.name),
-                        'market': row['market'], 'ticker': row['ticker'], 'name': row['name'],
-                        'trade_date': row['trade_date'], 'build_date': row.get('build_date',''),
-                        'quantity': row['quantity'], 'sell_price': row['sell_price'],
-                        'avg_cost': row['avg_cost'], 'realized_pl': row['realized_pl'],
-                        'realized_pl_pct': row['realized_pl_pct'],
-                    }
-                    if is_new_trade(row['trade_date']):
-                        new_trades.append(item)
-                    else:
-                        old_trades.append(item)
-
-                # 過去分はタグなしで即Sheetsへ保存
-                if old_trades and sheets_client and sid:
-                    save_rows = []
-                    for item in old_trades:
-                        bd = str(item.get('build_date',''))
-                        td = str(item['trade_date'])
-                        hold_d = ''
-                        if bd and bd not in ('','NaT','nan'):
-                            try:
-                                hold_d = str((datetime.strptime(td[:10],'%Y-%m-%d') - datetime.strptime(bd[:10],'%Y-%m-%d')).days)
-                            except: pass
-                        save_rows.append({
-                            'id': str(uuid.uuid4())[:8], 'market': item['market'],
-                            'ticker': item['ticker'], 'name': item['name'],
-                            'trade_date': td, 'build_date': bd,
-                            'quantity': item['quantity'], 'sell_price': item['sell_price'],
-                            'avg_cost': item['avg_cost'], 'realized_pl': item['realized_pl'],
-                            'realized_pl_pct': item['realized_pl_pct'], 'hold_days': hold_d,
-                            'tag_large':'', 'tag_medium':'', 'tag_small':'',
-                            'satisfaction':'', 'stop_loss_price':'', 'discipline':'0',
-                            'memo':'', 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        })
-                    existing = load_tradelog_cached(sid)
-                    new_df = pd.DataFrame(save_rows)
-                    combined_save = pd.concat([existing, new_df], ignore_index=True) if len(existing)>0 else new_df
-                    ok = write_sheet(sheets_client, sid, TRADELOG_SHEET, combined_save)
-                    if ok:
-                        reload_tradelog()
-                        st.success(f"📦 過去分 {len(old_trades)}件をタグなしで保存しました")
-
-                # 今日以降分はタグ付けキューへ
-                st.session_state['pending'] = new_trades
+                # 今日より前 → タグなし即保存 / 今日以降 → タグ付け対象
+                old_rows, new_rows = build_trade_rows(combined_r)
+
+                # 過去分はタグなしで即保存
+                if len(old_rows) > 0 and store:
+                    n = append_tradelog(store, old_rows)
+                    if n == len(old_rows):
+                        st.success(f"📦 過去分 {len(old_rows)}件をタグなしで保存しました")
+                    elif n:
+                        st.warning(f"📦 過去分 {len(old_rows)}件のうち {n}件だけ保存しました（残りは再取込で追加されます）")
+
+                # 今日以降分はタグ付けキューへ（行は pending_rows に1つだけ持ち、キューは行番号だけ）
+                st.session_state['pending_rows'] = compact_frame(new_rows.rename_axis('idx'))
+                st.session_state['pending'] = new_rows.index.tolist()
                 st.session_state['tag_state'] = {}
-                st.session_state['realized_df'] = combined_r
+                st.session_state['realized_df'] = compact_frame(combined_r)
 
-                if new_trades:
-                    st.info(f"🏷 今日以降の新規取引 {len(new_trades)}件 → タグ付けタブへ")
+                if len(new_rows):
+                    st.info(f"🏷 今日以降の新規取引 {len(new_rows)}件 → タグ付けタブへ")
                 else:
                     st.info("今日以降の新規取引はありません（全件タグなし保存済み）")
 
             if history_parts:
                 combined_h = pd.concat(history_parts, ignore_index=True)
-                st.session_state['history_df'] = combined_h
-                st.session_state['positions'] = calc_positions(combined_h)
+                st.session_state['history_df'] = compact_frame(combined_h)
+                if store:
+                    # 保存済みの保有状態に、市場ごとに未反映の約定だけを適用
+                    state, wm = load_position_state_cached(store.key)
+                    try:
+                        state, wm = apply_history(state, combined_h, wm)
+                    except ValueError as e:
+                        # 再実行するとメッセージが消えるので、この回はここで止める
+                        st.error(f"保有状態は更新していません: {e}"); st.stop()
+                    save_position_state(store, state, wm)
+                    st.session_state['positions'] = positions_view(state)
+                else:
+                    st.session_state['positions'] = calc_positions(combined_h)
 
             st.rerun()
 
@@ -674,101 +1887,187 @@ with tab_import:
 # ====================================================
 # TAB 2: タグ付け（今日以降の取引のみ）
 # ====================================================
-with tab_tag:
-    pending_list = st.session_state.get('pending', [])
-    tag_state    = st.session_state.get('tag_state', {})
-    has_pending  = len(pending_list) > 0
-
-    tagged_idxs   = {i for i, ts in tag_state.items() if ts.get('large')}
-    untagged_list = [p for p in pending_list if p['idx'] not in tagged_idxs]
-    tagged_list   = [p for p in pending_list if p['idx'] in tagged_idxs]
-    total_cnt = len(pending_list)
-
-    if not has_pending:
-        st.info("🏷 タグ付けするデータがありません。\n\n今日以降の新規取引をCSV取込すると、ここでタグ付けできます。\n（過去分はタグなしで自動保存されます）")
+TAG_PAGE_SIZE = 10
+TAG_LEVELS = ('large', 'medium', 'small')
+
+def toggle_tag(idx, level, tag):
+    """タグボタンのコールバック（同じタグなら解除。下位の階層はクリア）"""
+    ts = st.session_state['tag_state'].setdefault(idx, {})
+    lower = TAG_LEVELS[TAG_LEVELS.index(level) + 1:]
+    if ts.get(level) == tag:
+        lower = (level,) + lower
     else:
-        remain = len(untagged_list)
-        done   = len(tagged_list)
-        pct    = int(done / total_cnt * 100) if total_cnt > 0 else 0
+        ts[level] = tag
+    for k in lower: ts.pop(k, None)
 
-        col_h1, col_h2 = st.columns([3, 2])
-        with col_h1:
-            st.markdown(f"""
-<div style="padding:8px 0 4px;">
-  <span style="font-size:12px;color:var(--text2);">未タグ付け</span>
-  <span class="counter-badge" style="margin:0 8px;">{remain}件</span>
-  <span style="font-size:11px;color:var(--text2);">完了 {done}/{total_cnt}件</span>
-</div>""", unsafe_allow_html=True)
-        with col_h2:
-            can_save = bool(sheets_client and sid and done > 0)
-            if st.button(f"💾 {done}件をSheetsへ保存",
-                         disabled=not can_save,
-                         type="primary" if can_save else "secondary",
-                         use_container_width=True, key="bulk_save_btn"):
-                save_rows = []
-                for p_item in tagged_list:
-                    idx = p_item['idx']; ts = tag_state[idx]
-                    bd = str(p_item.get('build_date','')); td = str(p_item['trade_date'])
-                    hold_d = ''
-                    if bd and bd not in ('','NaT','nan'):
-                        try: hold_d = str((datetime.strptime(td[:10],'%Y-%m-%d') - datetime.strptime(bd[:10],'%Y-%m-%d')).days)
-                        except: pass
-                    save_rows.append({
-                        'id': str(uuid.uuid4())[:8], 'market': p_item['market'],
-                        'ticker': p_item['ticker'], 'name': p_item['name'],
-                        'trade_date': td, 'build_date': bd,
-                        'quantity': p_item['quantity'], 'sell_price': p_item['sell_price'],
-                        'avg_cost': p_item['avg_cost'], 'realized_pl': p_item['realized_pl'],
-                        'realized_pl_pct': p_item['realized_pl_pct'], 'hold_days': hold_d,
-                        'tag_large': ts.get('large',''), 'tag_medium': ts.get('medium',''),
-                        'tag_small': ts.get('small',''),
-                        'satisfaction': ts.get('satisfaction',''),
-                        'stop_loss_price': ts.get('stop_loss',''),
-                        'discipline': '1' if ts.get('discipline',False) else '0',
-                        'memo': ts.get('memo',''),
-                        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    })
-                if save_rows:
-                    existing = load_tradelog_cached(sid)
-                    new_df = pd.DataFrame(save_rows)
-                    combined_save = pd.concat([existing, new_df], ignore_index=True) if len(existing)>0 else new_df
-                    ok = write_sheet(sheets_client, sid, TRADELOG_SHEET, combined_save)
-                    if ok:
-                        reload_tradelog()
-                        saved_idxs = {p['idx'] for p in tagged_list}
-                        st.session_state['pending']   = [x for x in st.session_state['pending'] if x['idx'] not in saved_idxs]
-                        st.session_state['tag_state'] = {k:v for k,v in st.session_state['tag_state'].items() if k not in saved_idxs}
-                        st.success(f"✅ {len(save_rows)}件を保存しました！")
-                        st.rerun()
-
-        st.progress(pct / 100)
-
-        # ── 未タグ付けカード ──
-        if untagged_list:
-            st.markdown('<div class="section-title">未タグ付け</div>', unsafe_allow_html=True)
-
-            for p_item in untagged_list[:15]:
-                idx = p_item['idx']
-                ts  = tag_state.get(idx, {})
-                pl  = float(p_item['realized_pl'])
-                pl_pct = float(p_item.get('realized_pl_pct', 0))
-                flag = "🇯🇵" if p_item['market'] == '日本株' else "🇺🇸"
-
-                # カード色
-                if pl >= 0:
-                    card_border = "#ef5350"; card_bg = "rgba(239,83,80,0.06)"; pl_color = "#ef5350"
-                else:
-                    card_border = "#42a5f5"; card_bg = "rgba(66,165,245,0.06)"; pl_color = "#42a5f5"
+@st.fragment
+def render_auto_tagger():
+    """ルールでタグ案を一括作成 → 確認して採用（タグ付け待ち／過去の未タグ行）"""
+    pending_list = st.session_state.get('pending', [])
+    df_log = load_tradelog_cached(store.key) if store else pd.DataFrame(columns=TRADELOG_COLS)
+    tag_state = st.session_state['tag_state']
+    todo = [i for i in pending_list if not tag_state.get(i, {}).get('large')]
+    untagged_log = df_log[df_log['tag_large'].astype(str).str.strip() == '']
+    counts = {'pending': f"タグ付け待ち（{len(todo)}件）", 'log': f"過去の未タグ行（{len(untagged_log)}件）"}
+    target = st.radio("対象", list(counts), format_func=counts.get, horizontal=True, key='auto_target')
+
+    c1, c2 = st.columns(2)
+    use_hist = c1.checkbox("銘柄ごとの過去タグを引き継ぐ", value=True, key='auto_use_hist')
+    use_earn = c2.checkbox("決算日前後をイベントに", value=False, disabled=get_price_service() is None, key='auto_use_earn')
+    earn_days = c2.number_input("決算日 ±日数", min_value=1, max_value=30, value=3, key='auto_earn_days')
+
+    with st.form('auto_rule_form', clear_on_submit=True):
+        st.caption("条件ルール（保有日数・損益・取引日 → タグ）。上にあるルールほど優先")
+        f1, f2 = st.columns(2)
+        hold = f1.slider("保有日数（右端は上限なし）", 0, 365, (0, 365))
+        sign = f2.radio("損益", list(PL_SIGNS), horizontal=True)
+        dates = f1.date_input("取引日（任意）", value=[])
+        path = f2.selectbox("付けるタグ", TAG_PATHS)
+        if st.form_submit_button("＋ ルール追加", use_container_width=True):
+            hi = None if hold[1] >= 365 else hold[1]
+            dates = tuple(dates) if len(dates) == 2 else None
+            name = f"保有{hold[0]}〜{'' if hi is None else hi}日・{sign}" + (f"・{dates[0]}〜{dates[1]}" if dates else '') + f" → {path}"
+            st.session_state['auto_rules'].append({'kind': 'band', 'name': name, 'hold': (hold[0], hi),
+                                                   'pl': PL_SIGNS[sign], 'dates': dates, 'tags': path.split(' / ')})
+    for i, rule in enumerate(st.session_state['auto_rules']):
+        r1, r2 = st.columns([6, 1])
+        r1.caption(f"{i + 1}. {rule['name']}")
+        r2.button("✕", key=f"auto_del_{i}", on_click=st.session_state['auto_rules'].pop, args=(i,))
+
+    if st.button("🤖 タグ案を作成", use_container_width=True):
+        rules = ([{'kind': 'history', 'name': '過去タグ'}] if use_hist else []) \
+              + ([{'kind': 'earnings', 'name': f'決算±{earn_days}日', 'days': earn_days}] if use_earn else []) \
+              + st.session_state['auto_rules']
+        if target == 'pending':
+            tdf = st.session_state['pending_rows'].loc[todo] if todo else pd.DataFrame(columns=TRADELOG_COLS).rename_axis('idx')
+        else:
+            tdf = untagged_log.set_index('trade_key')
+        earnings = None
+        if use_earn and len(tdf):
+            syms = {price_symbol(t, m) for t, m in zip(tdf['ticker'].astype(str), tdf['market'].astype(str))}
+            earnings = load_earnings_dates(tuple(sorted(syms)))
+        prop = propose_tags(tdf, rules, tag_history(df_log) if use_hist else None, earnings)
+        hit = (prop['rule'] != '').to_numpy()
+        view = tdf.loc[hit, ['trade_date', 'ticker', 'name', 'realized_pl', 'hold_days']].join(prop[hit])
+        view.insert(0, '採用', True)
+        st.session_state['auto_proposals'] = (target, view)
+
+    proposals = st.session_state.get('auto_proposals')
+    if proposals and proposals[0] == target:
+        view = proposals[1]
+        if len(view) == 0:
+            st.info("どのルールにも当たりませんでした")
+            return
+        st.caption(f"{len(view)}件にタグ案（ルール別: " + ", ".join(f"{k} {v}件" for k, v in view['rule'].value_counts().items()) + "）")
+        edited = st.data_editor(view, disabled=[c for c in view.columns if c != '採用'],
+                                use_container_width=True, height=300, key='auto_editor')
+        acc = edited[edited['採用']]
+        if st.button(f"✅ 採用した {len(acc)}件に反映", disabled=len(acc) == 0, type="primary", use_container_width=True):
+            if target == 'pending':
+                for idx, row in zip(acc.index, acc[TAG_COLS].to_dict('records')):
+                    ts = tag_state.setdefault(idx, {})
+                    for lv, col in zip(TAG_LEVELS, TAG_COLS):
+                        if row[col]: ts[lv] = row[col]
+                        else: ts.pop(lv, None)
+                ok = True
+            else:
+                ok = update_tradelog_cells(store, acc[TAG_COLS]) is not None
+            if ok:
+                st.session_state['auto_proposals'] = None
+                st.rerun(scope='app')
+
+RETRO_EDIT_COLS = ['tag_large', 'tag_medium', 'tag_small', 'satisfaction', 'discipline', 'memo']
+RETRO_EDIT_LIMIT = 200
+
+def _cell_text(df):
+    # 編集値 → シートに書く文字列（discipline は 1/0、納得度は整数）
+    out = df.astype(object)
+    out['discipline'] = np.where(df['discipline'].fillna(False).astype(bool), '1', '0')
+    out['satisfaction'] = pd.to_numeric(df['satisfaction'], errors='coerce').round().astype('Int64').astype('string').fillna('')
+    return out.fillna('').astype(str)
+
+def valid_tag_paths(df):
+    """大・中・小が TAG_TREE のパス（または全て空）になっている行（空欄は末尾だけ可）"""
+    t = df[TAG_COLS].fillna('').astype(str)
+    path = (t['tag_large'] + ' / ' + t['tag_medium'] + ' / ' + t['tag_small']).str.replace(r'( / )+$', '', regex=True)
+    return path.eq('') | path.isin(TAG_PATHS)
+
+@st.fragment
+def render_retro_editor():
+    """登録済み Trade_Log 行を id で探して編集（変更したセルだけを送信）"""
+    if not store:
+        st.info("保存先が未接続のため編集できません"); return
+    df_log = load_tradelog_cached(store.key)
+    rows = tradelog_row_index(store.key, 'id')
+    f1, f2, f3 = st.columns([3, 2, 1])
+    ids = [x.strip() for x in f1.text_input("id（カンマ区切り）", key='retro_ids').split(',') if x.strip()]
+    tick = f2.text_input("銘柄コード", key='retro_ticker').strip()
+    only_untagged = f3.checkbox("未タグのみ", key='retro_untagged')
+    if ids:
+        view = df_log.iloc[rows.reindex(ids).dropna().astype(int).to_numpy()]
+    else:
+        view = df_log[df_log['id'].astype(str).isin(rows.index)]
+    if tick: view = view[view['ticker'].astype(str) == tick]
+    if only_untagged: view = view[view['tag_large'].astype(str).str.strip() == '']
+    if len(view) == 0:
+        st.info("該当する取引がありません"); return
+    view = view.sort_values('trade_date', ascending=False).head(RETRO_EDIT_LIMIT)
+    orig = pd.DataFrame({
+        'trade_date': view['trade_date'].dt.strftime('%Y-%m-%d'), 'ticker': view['ticker'].astype(str),
+        'name': view['name'].astype(str), 'realized_pl': view['realized_pl'],
+        'tag_large': view['tag_large'].astype(str), 'tag_medium': view['tag_medium'].astype(str),
+        'tag_small': view['tag_small'].astype(str), 'satisfaction': view['satisfaction'],
+        'discipline': view['discipline'].fillna(0).astype(int) == 1, 'memo': view['memo'].astype(str),
+    }).set_index(view['id'].astype(str).rename('id'))
+    st.caption(f"新しい順に最大{RETRO_EDIT_LIMIT}件（id重複の行は対象外）")
+    edited = st.data_editor(orig, key='retro_editor', use_container_width=True, height=360,
+                            disabled=['trade_date', 'ticker', 'name', 'realized_pl'], column_config={
+        'tag_large':    st.column_config.SelectboxColumn("大分類", options=[''] + LARGE_TAGS),
+        'tag_medium':   st.column_config.SelectboxColumn("中分類", options=[''] + sorted({m for ms in TAG_TREE.values() for m in ms})),
+        'tag_small':    st.column_config.SelectboxColumn("小分類", options=[''] + sorted({x for ms in TAG_TREE.values() for ss in ms.values() for x in ss})),
+        'satisfaction': st.column_config.NumberColumn("納得度", min_value=1, max_value=5, step=1),
+        'discipline':   st.column_config.CheckboxColumn("規律"),
+        'memo':         st.column_config.TextColumn("メモ"),
+    })
+    before, after = _cell_text(orig[RETRO_EDIT_COLS]), _cell_text(edited[RETRO_EDIT_COLS])
+    changes = after.where(after != before)
+    changes = changes[changes.notna().any(axis=1)]
+    n_cells = int(changes.notna().to_numpy().sum())
+    # 中・小の選択肢は全分類の和集合なので、タグを変えた行は大→中→小の組み合わせを確かめる
+    bad = changes.index[changes[TAG_COLS].notna().any(axis=1) & ~valid_tag_paths(edited.loc[changes.index])]
+    if len(bad):
+        st.error(f"大・中・小分類の組み合わせが分類表にない行があります（id: {', '.join(bad)}）。修正するまで保存できません")
+    if st.button(f"💾 変更した {n_cells}セル（{len(changes)}件）を保存", disabled=n_cells == 0 or len(bad) > 0,
+                 type="primary", use_container_width=True, key='retro_save'):
+        skipped = update_tradelog_cells(store, changes, key='id')
+        if skipped is not None:
+            st.session_state.pop('retro_editor', None)
+            st.rerun(scope='app')
+
+@st.fragment
+def render_tag_card(idx):
+    """タグ付けカード1件（ボタン操作はこのカードだけ再実行）"""
+    p_item = st.session_state['pending_rows'].loc[idx]
+    ts  = st.session_state['tag_state'].get(idx, {})
+    pl  = float(p_item['realized_pl'])
+    pl_pct = float(p_item.get('realized_pl_pct', 0))
+    flag = "🇯🇵" if p_item['market'] == '日本株' else "🇺🇸"
+
+    # カード色
+    if pl >= 0:
+        card_border = "#ef5350"; card_bg = "rgba(239,83,80,0.06)"; pl_color = "#ef5350"
+    else:
+        card_border = "#42a5f5"; card_bg = "rgba(66,165,245,0.06)"; pl_color = "#42a5f5"
 
-                sel_large = ts.get('large', '')
-                if sel_large and sel_large in TAG_COLORS:
-                    tc = TAG_COLORS[sel_large]
-                    card_border = tc
-                    card_bg = f"rgba({hex_to_rgb(tc)},0.08)"
+    sel_large = ts.get('large', '')
+    if sel_large and sel_large in TAG_COLORS:
+        tc = TAG_COLORS[sel_large]
+        card_border = tc
+        card_bg = f"rgba({hex_to_rgb(tc)},0.08)"
 
-                pl_sign = "+" if pl >= 0 else ""
+    pl_sign = "+" if pl >= 0 else ""
 
-                st.markdown(f"""
+    st.markdown(f"""
 <div style="background:{card_bg};border:1px solid #2a312e;border-left:4px solid {card_border};
      border-radius:10px;padding:14px 16px 8px;margin-bottom:4px;">
   <div style="display:flex;justify-content:space-between;align-items:flex-start;margin-bottom:8px;">
@@ -789,113 +2088,171 @@ with tab_tag:
   </div>
 </div>""", unsafe_allow_html=True)
 
-                # ── 大分類 ──
-                st.markdown('<span class="tag-layer-label tag-layer-large">大分類</span>', unsafe_allow_html=True)
-                lg_cols = st.columns(len(LARGE_TAGS))
-                for ci, tag in enumerate(LARGE_TAGS):
-                    with lg_cols[ci]:
-                        is_sel = ts.get('large') == tag
-                        label  = f"✓ {tag}" if is_sel else tag
-                        if st.button(label, key=f"lg_{idx}_{tag}", use_container_width=True):
-                            if idx not in st.session_state['tag_state']:
-                                st.session_state['tag_state'][idx] = {}
-                            if st.session_state['tag_state'][idx].get('large') == tag:
-                                # 選択解除 → 中・小も消す
-                                for k in ('large','medium','small'): st.session_state['tag_state'][idx].pop(k, None)
-                            else:
-                                st.session_state['tag_state'][idx]['large'] = tag
-                                for k in ('medium','small'): st.session_state['tag_state'][idx].pop(k, None)
-                            st.rerun()
-
-                # ── 中分類（大分類選択後）──
-                if ts.get('large') and ts['large'] in TAG_TREE:
-                    mediums = list(TAG_TREE[ts['large']].keys())
-                    st.markdown(f'<span class="tag-layer-label tag-layer-medium">中分類（{ts["large"]}）</span>', unsafe_allow_html=True)
-                    m_cols = st.columns(min(len(mediums), 4))
-                    for mi, mtag in enumerate(mediums):
-                        with m_cols[mi % 4]:
-                            is_sel = ts.get('medium') == mtag
-                            label  = f"✓ {mtag}" if is_sel else mtag
-                            if st.button(label, key=f"md_{idx}_{mtag}", use_container_width=True):
-                                if st.session_state['tag_state'][idx].get('medium') == mtag:
-                                    for k in ('medium','small'): st.session_state['tag_state'][idx].pop(k, None)
-                                else:
-                                    st.session_state['tag_state'][idx]['medium'] = mtag
-                                    st.session_state['tag_state'][idx].pop('small', None)
-                                st.rerun()
-
-                    # ── 小分類（中分類選択後）──
-                    sel_medium = ts.get('medium','')
-                    if sel_medium and sel_medium in TAG_TREE.get(ts['large'], {}):
-                        smalls = TAG_TREE[ts['large']][sel_medium]
-                        st.markdown(f'<span class="tag-layer-label tag-layer-small">小分類（{sel_medium}）</span>', unsafe_allow_html=True)
-                        s_cols = st.columns(min(len(smalls), 4))
-                        for si, stag in enumerate(smalls):
-                            with s_cols[si % 4]:
-                                is_sel = ts.get('small') == stag
-                                label  = f"✓ {stag}" if is_sel else stag
-                                if st.button(label, key=f"sm_{idx}_{stag}", use_container_width=True):
-                                    if st.session_state['tag_state'][idx].get('small') == stag:
-                                        st.session_state['tag_state'][idx].pop('small', None)
-                                    else:
-                                        st.session_state['tag_state'][idx]['small'] = stag
-                                    st.rerun()
-
-                # ── 納得度・損切り・規律・メモ（フォーム）──
-                with st.form(key=f"form_{idx}", clear_on_submit=False):
-                    col_sat, col_sl = st.columns(2)
-                    with col_sat:
-                        st.markdown('<div style="font-size:11px;color:var(--text2);margin-bottom:4px;">⭐ 納得度</div>', unsafe_allow_html=True)
-                        cur_sat = ts.get('satisfaction', 3)
-                        sat_val = st.select_slider("納得度", options=[1,2,3,4,5],
-                            value=cur_sat if cur_sat else 3,
-                            format_func=lambda x: "★"*x + "☆"*(5-x),
-                            key=f"sat_sl_{idx}", label_visibility='collapsed')
-                    with col_sl:
-                        st.markdown('<div style="font-size:11px;color:var(--text2);margin-bottom:4px;">🛑 当初損切り価格</div>', unsafe_allow_html=True)
-                        cur_sl_val = ts.get('stop_loss', 0.0)
-                        sl_val = st.number_input("損切り", min_value=0.0,
-                            value=float(cur_sl_val) if cur_sl_val else 0.0,
-                            step=1.0, format="%.1f", key=f"sl_f_{idx}", label_visibility='collapsed')
-                    disc_val = st.checkbox("✅ 損切りルールを守った", value=ts.get('discipline',False), key=f"disc_f_{idx}")
-                    memo_val = st.text_input("💬 メモ（任意）", value=ts.get('memo',''), key=f"memo_f_{idx}")
-
-                    submitted = st.form_submit_button("✔ この件を確定", use_container_width=True)
-                    if submitted:
-                        if idx not in st.session_state['tag_state']:
-                            st.session_state['tag_state'][idx] = {}
-                        st.session_state['tag_state'][idx].update({
-                            'satisfaction': sat_val, 'stop_loss': sl_val,
-                            'discipline': disc_val, 'memo': memo_val,
-                        })
-                        if not st.session_state['tag_state'][idx].get('large'):
-                            st.warning("大分類を選択してください")
-                        else:
-                            st.rerun()
-
-                st.markdown('<div style="height:12px;border-bottom:1px solid #2a312e;margin-bottom:12px;"></div>', unsafe_allow_html=True)
-
-            if len(untagged_list) > 15:
-                st.caption(f"残り {len(untagged_list) - 15}件は確定後に表示されます")
+    # ── 大分類 ──
+    st.markdown('<span class="tag-layer-label tag-layer-large">大分類</span>', unsafe_allow_html=True)
+    lg_cols = st.columns(len(LARGE_TAGS))
+    for ci, tag in enumerate(LARGE_TAGS):
+        with lg_cols[ci]:
+            is_sel = ts.get('large') == tag
+            label  = f"✓ {tag}" if is_sel else tag
+            st.button(label, key=f"lg_{idx}_{tag}", use_container_width=True,
+                      on_click=toggle_tag, args=(idx, 'large', tag))
+
+    # ── 中分類（大分類選択後）──
+    if ts.get('large') and ts['large'] in TAG_TREE:
+        mediums = list(TAG_TREE[ts['large']].keys())
+        st.markdown(f'<span class="tag-layer-label tag-layer-medium">中分類（{ts["large"]}）</span>', unsafe_allow_html=True)
+        m_cols = st.columns(min(len(mediums), 4))
+        for mi, mtag in enumerate(mediums):
+            with m_cols[mi % 4]:
+                is_sel = ts.get('medium') == mtag
+                label  = f"✓ {mtag}" if is_sel else mtag
+                st.button(label, key=f"md_{idx}_{mtag}", use_container_width=True,
+                          on_click=toggle_tag, args=(idx, 'medium', mtag))
+
+        # ── 小分類（中分類選択後）──
+        sel_medium = ts.get('medium','')
+        if sel_medium and sel_medium in TAG_TREE.get(ts['large'], {}):
+            smalls = TAG_TREE[ts['large']][sel_medium]
+            st.markdown(f'<span class="tag-layer-label tag-layer-small">小分類（{sel_medium}）</span>', unsafe_allow_html=True)
+            s_cols = st.columns(min(len(smalls), 4))
+            for si, stag in enumerate(smalls):
+                with s_cols[si % 4]:
+                    is_sel = ts.get('small') == stag
+                    label  = f"✓ {stag}" if is_sel else stag
+                    st.button(label, key=f"sm_{idx}_{stag}", use_container_width=True,
+                              on_click=toggle_tag, args=(idx, 'small', stag))
+
+    # ── 納得度・損切り・規律・メモ（フォーム）──
+    with st.form(key=f"form_{idx}", clear_on_submit=False):
+        col_sat, col_sl = st.columns(2)
+        with col_sat:
+            st.markdown('<div style="font-size:11px;color:var(--text2);margin-bottom:4px;">⭐ 納得度</div>', unsafe_allow_html=True)
+            cur_sat = ts.get('satisfaction', 3)
+            sat_val = st.select_slider("納得度", options=[1,2,3,4,5],
+                value=cur_sat if cur_sat else 3,
+                format_func=lambda x: "★"*x + "☆"*(5-x),
+                key=f"sat_sl_{idx}", label_visibility='collapsed')
+        with col_sl:
+            st.markdown('<div style="font-size:11px;color:var(--text2);margin-bottom:4px;">🛑 当初損切り価格</div>', unsafe_allow_html=True)
+            cur_sl_val = ts.get('stop_loss', 0.0)
+            sl_val = st.number_input("損切り", min_value=0.0,
+                value=float(cur_sl_val) if cur_sl_val else 0.0,
+                step=1.0, format="%.1f", key=f"sl_f_{idx}", label_visibility='collapsed')
+        disc_val = st.checkbox("✅ 損切りルールを守った", value=ts.get('discipline',False), key=f"disc_f_{idx}")
+        memo_val = st.text_input("💬 メモ（任意）", value=ts.get('memo',''), key=f"memo_f_{idx}")
+
+        submitted = st.form_submit_button("✔ この件を確定", use_container_width=True)
+        if submitted:
+            if idx not in st.session_state['tag_state']:
+                st.session_state['tag_state'][idx] = {}
+            st.session_state['tag_state'][idx].update({
+                'satisfaction': sat_val, 'stop_loss': sl_val,
+                'discipline': disc_val, 'memo': memo_val,
+            })
+            if not st.session_state['tag_state'][idx].get('large'):
+                st.warning("大分類を選択してください")
+            else:
+                st.rerun(scope='app')  # 確定済み一覧へ移す
 
-        # ── 確定済み（未保存）一覧 ──
-        if tagged_list:
-            st.markdown('<div class="section-title">確定済み（Sheets未保存）</div>', unsafe_allow_html=True)
-            for p_item in tagged_list:
-                idx = p_item['idx']; ts = tag_state[idx]
-                pl  = float(p_item['realized_pl'])
-                pl_color = "#ef5350" if pl >= 0 else "#42a5f5"
-                flag = "🇯🇵" if p_item['market'] == '日本株' else "🇺🇸"
-                tag_c = TAG_COLORS.get(ts.get('large',''), '#00e676')
-                sign  = "+" if pl >= 0 else ""
-                sat_stars = "★" * int(ts.get('satisfaction') or 0)
+    st.markdown('<div style="height:12px;border-bottom:1px solid #2a312e;margin-bottom:12px;"></div>', unsafe_allow_html=True)
 
-                badges = f'<span class="badge" style="background:rgba({hex_to_rgb(tag_c)},0.15);color:{tag_c};border:1px solid {tag_c}40;">{ts.get("large","")}</span>'
-                if ts.get('medium'): badges += f' <span class="badge badge-tagged">{ts["medium"]}</span>'
-                if ts.get('small'):  badges += f' <span class="badge badge-pending">{ts["small"]}</span>'
-                if sat_stars:        badges += f' <span style="font-size:11px;color:#ffca28;">{sat_stars}</span>'
+with tab_tag:
+    if tab_open(tab_tag):
+        pending_list = st.session_state.get('pending', [])
+        pending_rows = st.session_state.get('pending_rows')
+        tag_state    = st.session_state.get('tag_state', {})
+        has_pending  = len(pending_list) > 0
+
+        tagged_idxs   = {i for i, ts in tag_state.items() if ts.get('large')}
+        untagged_list = [i for i in pending_list if i not in tagged_idxs]
+        tagged_list   = [i for i in pending_list if i in tagged_idxs]
+        total_cnt = len(pending_list)
+
+        with st.expander("🤖 自動タグ付け（ルールで一括）"):
+            render_auto_tagger()
+        with st.expander("✏️ 登録済み取引の編集"):
+            render_retro_editor()
+
+        if not has_pending:
+            st.info("🏷 タグ付けするデータがありません。\n\n今日以降の新規取引をCSV取込すると、ここでタグ付けできます。\n（過去分はタグなしで自動保存されます）")
+        else:
+            remain = len(untagged_list)
+            done   = len(tagged_list)
+            pct    = int(done / total_cnt * 100) if total_cnt > 0 else 0
 
+            col_h1, col_h2 = st.columns([3, 2])
+            with col_h1:
                 st.markdown(f"""
+<div style="padding:8px 0 4px;">
+  <span style="font-size:12px;color:var(--text2);">未タグ付け</span>
+  <span class="counter-badge" style="margin:0 8px;">{remain}件</span>
+  <span style="font-size:11px;color:var(--text2);">完了 {done}/{total_cnt}件</span>
+</div>""", unsafe_allow_html=True)
+            with col_h2:
+                can_save = bool(store and done > 0)
+                if st.button(f"💾 {done}件を{store.label if store else '保存先'}へ保存",
+                             disabled=not can_save,
+                             type="primary" if can_save else "secondary",
+                             use_container_width=True, key="bulk_save_btn"):
+                    save_rows = pending_rows.loc[tagged_list]
+                    if len(save_rows) > 0:
+                        tss = [tag_state[i] for i in tagged_list]
+                        save_rows = save_rows.assign(
+                            tag_large=[ts.get('large','') for ts in tss],
+                            tag_medium=[ts.get('medium','') for ts in tss],
+                            tag_small=[ts.get('small','') for ts in tss],
+                            satisfaction=[ts.get('satisfaction','') for ts in tss],
+                            stop_loss_price=[ts.get('stop_loss','') for ts in tss],
+                            discipline=['1' if ts.get('discipline',False) else '0' for ts in tss],
+                            memo=[ts.get('memo','') for ts in tss],
+                            created_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        )[TRADELOG_COLS]
+                        n = append_tradelog(store, save_rows)
+                        if n:
+                            # 途中で失敗しても書けた行（先頭 n 件）はキューから外す（再保存で重複させない）
+                            saved_idxs = set(tagged_list[:n])
+                            st.session_state['pending']   = [x for x in st.session_state['pending'] if x not in saved_idxs]
+                            st.session_state['pending_rows'] = pending_rows.drop(list(saved_idxs))
+                            st.session_state['tag_state'] = {k:v for k,v in st.session_state['tag_state'].items() if k not in saved_idxs}
+                            if n < len(save_rows):
+                                st.warning(f"{len(save_rows)}件のうち {n}件だけ保存しました。残りはもう一度保存してください"); st.stop()
+                            st.success(f"✅ {len(save_rows)}件を保存しました！")
+                            st.rerun()
+
+            st.progress(pct / 100)
+
+            # ── 未タグ付けカード ──
+            if untagged_list:
+                st.markdown('<div class="section-title">未タグ付け</div>', unsafe_allow_html=True)
+
+                pages = (len(untagged_list) - 1) // TAG_PAGE_SIZE + 1
+                if st.session_state.get('tag_page', 1) > pages:
+                    st.session_state['tag_page'] = pages
+                page = st.number_input(f"ページ（全{pages}ページ・{TAG_PAGE_SIZE}件ずつ）", min_value=1,
+                                       max_value=pages, step=1, key='tag_page') if pages > 1 else 1
+                start = (page - 1) * TAG_PAGE_SIZE
+                for idx in untagged_list[start:start + TAG_PAGE_SIZE]:
+                    render_tag_card(idx)
+
+            # ── 確定済み（未保存）一覧 ──
+            if tagged_list:
+                st.markdown('<div class="section-title">確定済み（未保存）</div>', unsafe_allow_html=True)
+                for idx, p_item in pending_rows.loc[tagged_list].iterrows():
+                    ts = tag_state[idx]
+                    pl  = float(p_item['realized_pl'])
+                    pl_color = "#ef5350" if pl >= 0 else "#42a5f5"
+                    flag = "🇯🇵" if p_item['market'] == '日本株' else "🇺🇸"
+                    tag_c = TAG_COLORS.get(ts.get('large',''), '#00e676')
+                    sign  = "+" if pl >= 0 else ""
+                    sat_stars = "★" * int(ts.get('satisfaction') or 0)
+
+                    badges = f'<span class="badge" style="background:rgba({hex_to_rgb(tag_c)},0.15);color:{tag_c};border:1px solid {tag_c}40;">{ts.get("large","")}</span>'
+                    if ts.get('medium'): badges += f' <span class="badge badge-tagged">{ts["medium"]}</span>'
+                    if ts.get('small'):  badges += f' <span class="badge badge-pending">{ts["small"]}</span>'
+                    if sat_stars:        badges += f' <span style="font-size:11px;color:#ffca28;">{sat_stars}</span>'
+
+                    st.markdown(f"""
 <div style="background:var(--surface);border:1px solid #2a312e;border-left:4px solid {tag_c};
      border-radius:8px;padding:10px 14px;margin-bottom:6px;
      display:flex;justify-content:space-between;align-items:center;opacity:0.85;">
@@ -909,45 +2266,35 @@ with tab_tag:
 # ====================================================
 # TAB 3: 分析ダッシュボード
 # ====================================================
-with tab_dash:
-    if sheets_client and sid:
-        df_log = load_tradelog_cached(sid)
+@st.fragment
+def render_dashboard():
+    """分析タブ本体（期間切替などはこの中だけ再実行）"""
+    if store:
+        df_log = load_tradelog_cached(store.key)
     else:
         df_log = pd.DataFrame(columns=TRADELOG_COLS)
 
     if len(df_log) == 0:
         st.info("分析データがありません。CSVを取込んでください。")
     else:
-        df_log['realized_pl']     = pd.to_numeric(df_log['realized_pl'], errors='coerce').fillna(0)
-        df_log['realized_pl_pct'] = pd.to_numeric(df_log['realized_pl_pct'], errors='coerce').fillna(0)
-        df_log['quantity']        = pd.to_numeric(df_log['quantity'], errors='coerce').fillna(0)
-        df_log['hold_days']       = pd.to_numeric(df_log['hold_days'], errors='coerce')
-        df_log['satisfaction']    = pd.to_numeric(df_log['satisfaction'], errors='coerce')
-        df_log['trade_date']      = pd.to_datetime(df_log['trade_date'], errors='coerce')
-        df_log = df_log.dropna(subset=['trade_date'])
-
-        # 期間フィルター
-        period_opt = st.radio("期間", ["全期間", "過去1年", "過去1ヶ月"], horizontal=True)
-        today_ts = pd.Timestamp.today()
-        if period_opt == "過去1年":
-            df_f = df_log[df_log['trade_date'] >= today_ts - timedelta(days=365)]
-        elif period_opt == "過去1ヶ月":
-            df_f = df_log[df_log['trade_date'] >= today_ts - timedelta(days=30)]
-        else:
-            df_f = df_log.copy()
-
-        df_f = df_f.copy()
+        # 期間フィルター（集計はデータ版・期間ごとにキャッシュ）
+        version = df_log.attrs.get('version')
+        df_sorted = sorted_tradelog(version, df_log)
+        period_opt = st.radio("期間", list(PERIOD_DAYS), horizontal=True)
+        start = end = None
+        if period_opt == "期間指定" and len(df_sorted) > 0:
+            lo, hi = df_sorted['trade_date'].iloc[0].date(), df_sorted['trade_date'].iloc[-1].date()
+            rng = st.date_input("範囲", value=(lo, hi), min_value=lo, max_value=hi)
+            start, end = (rng[0], rng[-1]) if rng else (None, None)
+        elif PERIOD_DAYS[period_opt] is not None:
+            start = TODAY - timedelta(days=PERIOD_DAYS[period_opt] - 1)
+        cube = analytics_cube(version, start, end, df_sorted, store)
 
         # ==================== KPI ====================
-        total_pl     = df_f['realized_pl'].sum()
-        total_trades = len(df_f)
-        wins         = (df_f['realized_pl'] > 0).sum()
-        losses       = (df_f['realized_pl'] < 0).sum()
-        win_rate     = wins / total_trades * 100 if total_trades > 0 else 0
-        avg_win      = df_f[df_f['realized_pl'] > 0]['realized_pl'].mean() if wins > 0 else 0
-        avg_loss     = abs(df_f[df_f['realized_pl'] < 0]['realized_pl'].mean()) if losses > 0 else 1
-        pf           = avg_win / avg_loss if avg_loss > 0 else 0
-        tagged_cnt   = df_f['tag_large'].astype(str).str.strip().ne('').sum()
+        kpi = cube['kpi']
+        total_pl, total_trades = kpi['total_pl'], kpi['total_trades']
+        wins, losses, win_rate = kpi['wins'], kpi['losses'], kpi['win_rate']
+        pf, tagged_cnt = kpi['pf'], kpi['tagged_cnt']
 
         pl_cls = "val-pos" if total_pl >= 0 else "val-neg"
         sign   = "+" if total_pl >= 0 else ""
@@ -975,11 +2322,7 @@ with tab_dash:
 
         # ==================== 損益推移 ====================
         st.markdown('<div class="section-title">損益推移</div>', unsafe_allow_html=True)
-        df_daily = df_f.groupby(df_f['trade_date'].dt.date)['realized_pl'].sum().reset_index()
-        df_daily.columns = ['date','daily_pl']
-        df_daily = df_daily.sort_values('date')
-        df_daily['cumulative'] = df_daily['daily_pl'].cumsum()
-        df_daily['color'] = df_daily['daily_pl'].apply(lambda x: '#ef5350' if x >= 0 else '#42a5f5')
+        df_daily = cube['daily']
 
         fig = go.Figure()
         fig.add_trace(go.Bar(x=df_daily['date'], y=df_daily['daily_pl'],
@@ -1001,28 +2344,11 @@ with tab_dash:
 
         # ==================== 銘柄別スタッツ ====================
         st.markdown('<div class="section-title">銘柄別スタッツ</div>', unsafe_allow_html=True)
-        ticker_stats = df_f.groupby('ticker').agg(
-            名前=('name','last'), 取引数=('realized_pl','count'),
-            勝率=('realized_pl', lambda x: round((x>0).mean()*100,1)),
-            総損益=('realized_pl','sum'), 平均損益=('realized_pl','mean'),
-            平均利益=('realized_pl', lambda x: round(x[x>0].mean(),0) if (x>0).any() else 0),
-            平均損失=('realized_pl', lambda x: round(abs(x[x<0].mean()),0) if (x<0).any() else 0),
-            平均保有日=('hold_days','mean'),
-        ).round(1).sort_values('総損益', ascending=False).reset_index()
-        ticker_stats['総損益']  = ticker_stats['総損益'].astype(int)
-        ticker_stats['平均損益'] = ticker_stats['平均損益'].round(0).astype(int)
-        st.dataframe(ticker_stats, use_container_width=True, height=280)
+        st.dataframe(cube['ticker_stats'], use_container_width=True, height=280)
 
         # ==================== 曜日別 ====================
         st.markdown('<div class="section-title">曜日別 勝率</div>', unsafe_allow_html=True)
-        df_f['weekday'] = df_f['trade_date'].dt.day_name()
-        day_order = ['Monday','Tuesday','Wednesday','Thursday','Friday']
-        day_jp    = {'Monday':'月','Tuesday':'火','Wednesday':'水','Thursday':'木','Friday':'金'}
-        wday = df_f.groupby('weekday').agg(
-            勝率=('realized_pl', lambda x: round((x>0).mean()*100,1)),
-            総損益=('realized_pl','sum'), 件数=('realized_pl','count'),
-        ).reindex([d for d in day_order if d in df_f['weekday'].unique()]).reset_index()
-        wday['曜日'] = wday['weekday'].map(day_jp)
+        wday = cube['wday']
         fig2 = go.Figure()
         fig2.add_trace(go.Bar(x=wday['曜日'], y=wday['勝率'], marker_color='#00e676', opacity=0.8,
                               text=wday['勝率'].apply(lambda x: f"{x:.0f}%"),
@@ -1035,18 +2361,11 @@ with tab_dash:
         st.plotly_chart(fig2, use_container_width=True)
 
         # ==================== タグ別（タグありデータのみ）====================
-        tagged_df = df_f[df_f['tag_large'].astype(str).str.strip() != '']
-        if len(tagged_df) > 0:
+        if tagged_cnt > 0:
             st.markdown('<div class="section-title">タグ別パフォーマンス（タグ付き取引のみ）</div>', unsafe_allow_html=True)
 
             # 大分類別
-            tag_stats = tagged_df.groupby('tag_large').agg(
-                件数=('realized_pl','count'),
-                勝率=('realized_pl', lambda x: round((x>0).mean()*100,1)),
-                総損益=('realized_pl','sum'), 平均損益=('realized_pl','mean'),
-                平均納得度=('satisfaction','mean'),
-            ).round(1).sort_values('総損益', ascending=False).reset_index()
-            tag_stats['総損益'] = tag_stats['総損益'].astype(int)
+            tag_stats = cube['tag_stats']
 
             col_t1, col_t2 = st.columns(2)
             with col_t1:
@@ -1065,33 +2384,25 @@ with tab_dash:
                 st.plotly_chart(fig4, use_container_width=True)
 
             # 中分類別（データがあれば）
-            if 'tag_medium' in tagged_df.columns:
-                med_df = tagged_df[tagged_df['tag_medium'].astype(str).str.strip() != '']
-                if len(med_df) > 0:
-                    st.markdown('<div class="section-title">中分類別 損益</div>', unsafe_allow_html=True)
-                    med_stats = med_df.groupby(['tag_large','tag_medium']).agg(
-                        件数=('realized_pl','count'),
-                        勝率=('realized_pl', lambda x: round((x>0).mean()*100,1)),
-                        総損益=('realized_pl','sum'),
-                    ).reset_index()
-                    med_stats['総損益'] = med_stats['総損益'].astype(int)
-                    med_stats['ラベル'] = med_stats['tag_large'] + '/' + med_stats['tag_medium']
-                    fig_med = px.bar(med_stats.sort_values('総損益'), x='総損益', y='ラベル',
-                                     orientation='h', color='勝率',
-                                     color_continuous_scale=[[0,'#42a5f5'],[0.5,'#ffca28'],[1,'#ef5350']],
-                                     title='中分類別 総損益')
-                    fig_med.update_layout(height=max(240, len(med_stats)*28),
-                                          paper_bgcolor='#161a18', plot_bgcolor='#161a18',
-                                          font_color='#8a9e91', title_font_size=11,
-                                          margin=dict(l=0,r=0,t=30,b=0))
-                    st.plotly_chart(fig_med, use_container_width=True)
+            med_stats = cube['med_stats']
+            if len(med_stats) > 0:
+                st.markdown('<div class="section-title">中分類別 損益</div>', unsafe_allow_html=True)
+                fig_med = px.bar(med_stats.sort_values('総損益'), x='総損益', y='ラベル',
+                                 orientation='h', color='勝率',
+                                 color_continuous_scale=[[0,'#42a5f5'],[0.5,'#ffca28'],[1,'#ef5350']],
+                                 title='中分類別 総損益')
+                fig_med.update_layout(height=max(240, len(med_stats)*28),
+                                      paper_bgcolor='#161a18', plot_bgcolor='#161a18',
+                                      font_color='#8a9e91', title_font_size=11,
+                                      margin=dict(l=0,r=0,t=30,b=0))
+                st.plotly_chart(fig_med, use_container_width=True)
 
         # 保有期間分布
-        hold_df = df_f.dropna(subset=['hold_days'])
-        if len(hold_df) > 0:
+        hold_days = cube['hold_days']
+        if len(hold_days) > 0:
             st.markdown('<div class="section-title">保有期間分布</div>', unsafe_allow_html=True)
-            avg_hold = hold_df['hold_days'].mean()
-            fig5 = px.histogram(hold_df, x='hold_days', nbins=30,
+            avg_hold = hold_days.mean()
+            fig5 = px.histogram(hold_days.to_frame(), x='hold_days', nbins=30,
                                 title=f'保有期間（平均 {avg_hold:.0f}日）',
                                 labels={'hold_days':'保有日数'},
                                 color_discrete_sequence=['#00e676'])
@@ -1100,66 +2411,74 @@ with tab_dash:
                                margin=dict(l=0,r=0,t=30,b=0))
             st.plotly_chart(fig5, use_container_width=True)
 
+with tab_dash:
+    if tab_open(tab_dash):
+        render_dashboard()
+
 # ====================================================
 # TAB 4: 保有ポジション
 # ====================================================
 with tab_pos:
-    st.markdown('<div class="section-title">現在の保有ポジション</div>', unsafe_allow_html=True)
-    pos_df = st.session_state.get('positions')
-
-    if pos_df is None or len(pos_df) == 0:
-        st.info("「取込」タブで取引履歴CSVを読み込むと、現在の保有ポジションが計算されます。")
-    else:
-        col_pb, col_pi = st.columns([1,3])
-        with col_pb:
-            do_fetch = st.button("📡 株価取得", use_container_width=True)
-        with col_pi:
-            cache_t = st.session_state.get('price_cache_time','')
-            st.caption(f"{'⚠️ yfinance未インストール' if not YFINANCE_AVAILABLE else f'15分遅延　{cache_t}'}")
-
-        if do_fetch and YFINANCE_AVAILABLE:
-            with st.spinner("取得中..."):
-                cache = {}
-                for _, row in pos_df.iterrows():
-                    t = f"{row['ticker']}.T" if row['market']=='日本株' else row['ticker']
-                    try:
-                        hist = yf.Ticker(t).history(period='2d')
-                        cache[row['ticker']] = float(hist['Close'].iloc[-1]) if len(hist)>0 else None
-                    except: cache[row['ticker']] = None
-                st.session_state['price_cache'] = cache
-                st.session_state['price_cache_time'] = datetime.now().strftime('%H:%M')
-            st.rerun()
-
-        price_cache = st.session_state.get('price_cache', {})
-        total_cost  = sum(float(r['avg_price'])*int(r['quantity']) for _,r in pos_df.iterrows())
-        total_upnl  = sum((price_cache.get(r['ticker'],0) or 0 - float(r['avg_price']))*int(r['quantity'])
-                          for _,r in pos_df.iterrows() if price_cache.get(r['ticker']))
-
-        upnl_cls = "val-pos" if total_upnl >= 0 else "val-neg"
-        sign_u   = "+" if total_upnl >= 0 else ""
-        upnl_pct = total_upnl / total_cost * 100 if total_cost > 0 else 0
+    if tab_open(tab_pos):
+        st.markdown('<div class="section-title">現在の保有ポジション</div>', unsafe_allow_html=True)
+        pos_df = st.session_state.get('positions')
+        if pos_df is None and store:
+            pos_df = positions_view(load_position_state_cached(store.key)[0])
+
+        if pos_df is None or len(pos_df) == 0:
+            st.info("「取込」タブで取引履歴CSVを読み込むと、現在の保有ポジションが計算されます。")
+        else:
+            price_svc = get_price_service()
+            symbols = {t: price_symbol(t, m) for t, m in zip(pos_df['ticker'], pos_df['market'])}
+            col_pb, col_pi = st.columns([1,3])
+            with col_pb:
+                do_fetch = st.button("📡 株価取得", use_container_width=True)
+            with col_pi:
+                fetched = price_svc.fetched_at(list(symbols.values())) if price_svc else None
+                cache_t = datetime.fromtimestamp(fetched).strftime('%H:%M') if fetched else ''
+                st.caption(f"{'⚠️ 株価プロバイダなし（yfinance未インストール）' if not price_svc else f'15分遅延　{cache_t}'}")
+
+            hist_store = get_price_history_store()
+            if do_fetch and price_svc:
+                with st.spinner("取得中..."):
+                    price_svc.quotes(list(symbols.values()))
+                    hist_store.update(list(symbols.values()))
+                st.rerun()
+
+            # 最新値が無い銘柄（未取得・取得失敗・オフライン）はローカル日足の最終終値
+            quotes = {**hist_store.last_close(list(symbols.values())),
+                      **(price_svc.peek(list(symbols.values())) if price_svc else {})}
+            price_cache = {t: quotes.get(sym) for t, sym in symbols.items()}
+            cur_px = pos_df['ticker'].map(price_cache).astype(float)
+            cost   = pos_df['avg_price'].astype(float) * pos_df['quantity'].astype(int)
+            total_cost  = cost.sum()
+            total_upnl  = ((cur_px - pos_df['avg_price'].astype(float)) * pos_df['quantity'].astype(int)).sum()
+
+            upnl_cls = "val-pos" if total_upnl >= 0 else "val-neg"
+            sign_u   = "+" if total_upnl >= 0 else ""
+            upnl_pct = total_upnl / total_cost * 100 if total_cost > 0 else 0
 
-        st.markdown(f"""
+            st.markdown(f"""
 <div class="stat-grid">
   <div class="stat-card"><div class="stat-val">{len(pos_df)}</div><div class="stat-lbl">保有銘柄数</div></div>
   <div class="stat-card"><div class="stat-val">¥{total_cost:,.0f}</div><div class="stat-lbl">評価額（簿価）</div></div>
   <div class="stat-card"><div class="stat-val {upnl_cls}">{sign_u}{upnl_pct:.1f}%</div><div class="stat-lbl">含み損益</div></div>
 </div>""", unsafe_allow_html=True)
 
-        for _, row in pos_df.sort_values('ticker').iterrows():
-            cp  = price_cache.get(row['ticker'])
-            avg = float(row['avg_price']); qty = int(row['quantity'])
-            type_label = "信用" if row['type']=='margin' else "現物"
-            flag = "🇯🇵" if row['market']=='日本株' else "🇺🇸"
-            if cp and avg > 0:
-                upnl = (cp-avg)*qty; upnl_pct_r = (cp-avg)/avg*100
-                upnl_str = f"{'+'if upnl>=0 else ''}¥{upnl:,.0f} ({upnl_pct_r:+.1f}%)"
-                upnl_color = "var(--red)" if upnl>=0 else "var(--blue)"
-                cp_str = f"¥{cp:,.1f}"
-            else:
-                upnl_str = "—"; upnl_color = "var(--text2)"; cp_str = "取得中..."
+            for _, row in pos_df.sort_values('ticker').iterrows():
+                cp  = price_cache.get(row['ticker'])
+                avg = float(row['avg_price']); qty = int(row['quantity'])
+                type_label = "信用" if row['type']=='margin' else "現物"
+                flag = "🇯🇵" if row['market']=='日本株' else "🇺🇸"
+                if cp and avg > 0:
+                    upnl = (cp-avg)*qty; upnl_pct_r = (cp-avg)/avg*100
+                    upnl_str = f"{'+'if upnl>=0 else ''}¥{upnl:,.0f} ({upnl_pct_r:+.1f}%)"
+                    upnl_color = "var(--red)" if upnl>=0 else "var(--blue)"
+                    cp_str = f"¥{cp:,.1f}"
+                else:
+                    upnl_str = "—"; upnl_color = "var(--text2)"; cp_str = "取得中..."
 
-            st.markdown(f"""
+                st.markdown(f"""
 <div class="pos-row">
   <div>
     <div class="pos-ticker">{flag} {row['ticker']}</div>
@@ -1175,31 +2494,13 @@ with tab_pos:
 # ====================================================
 # TAB 5: 設定
 # ====================================================
-with tab_settings:
-    st.markdown('<div class="section-title">接続情報</div>', unsafe_allow_html=True)
-    if sid:
-        st.code(f"SPREADSHEET_ID: {sid}")
-        st.caption(f"Sheets接続: {'✅ OK' if sheets_client else '❌ 未接続'}")
-    else:
-        st.warning("SPREADSHEET_ID が未設定です。")
-        st.markdown("**必要な環境変数（Railway）:**\n- `GCP_SERVICE_ACCOUNT_JSON`\n- `SPREADSHEET_ID`")
-
-    st.markdown('<div class="section-title">データ操作</div>', unsafe_allow_html=True)
-    col_c1, col_c2 = st.columns(2)
-    with col_c1:
-        if st.button("🔄 Sheetsキャッシュをクリア", use_container_width=True):
-            reload_tradelog(); st.success("✅ クリアしました")
-    with col_c2:
-        if st.button("🗑 メモリをリセット", use_container_width=True):
-            for k in ['realized_df','history_df','pending','tag_state','positions','price_cache']:
-                st.session_state.pop(k, None)
-            init_state(); st.success("✅ リセットしました")
-
+@st.fragment
+def render_tradelog_view():
+    """Trade_Log 一覧（設定タブを開いている時だけ実行）"""
     st.markdown('<div class="section-title">Trade_Log データ一覧</div>', unsafe_allow_html=True)
-    if sheets_client and sid:
-        df_view = load_tradelog_cached(sid)
+    if store:
+        df_view = load_tradelog_cached(store.key)
         if len(df_view) > 0:
-            df_view['realized_pl'] = pd.to_numeric(df_view['realized_pl'], errors='coerce')
             st.caption(f"登録済み: {len(df_view)}件（うちタグ付き: {df_view['tag_large'].astype(str).str.strip().ne('').sum()}件）")
             view_cols = ['trade_date','market','ticker','name','realized_pl','tag_large','tag_medium','tag_small','satisfaction']
             view_cols_exist = [c for c in view_cols if c in df_view.columns]
@@ -1210,12 +2511,66 @@ with tab_settings:
             if st.button("⚠️ 全データ削除（確認してから押す）", use_container_width=True):
                 st.warning("本当に削除しますか？")
                 if st.checkbox("はい、全データを削除します"):
-                    write_sheet(sheets_client, sid, TRADELOG_SHEET, pd.DataFrame(columns=TRADELOG_COLS))
-                    reload_tradelog(); st.success("✅ 削除しました"); st.rerun()
+                    store.write(TRADELOG_SHEET, pd.DataFrame(columns=TRADELOG_COLS))
+                    reload_tradelog(full=True); st.success("✅ 削除しました"); st.rerun()
         else:
             st.info("データなし")
     else:
-        st.info("Sheets未接続のため表示できません")
+        st.info("保存先が未接続のため表示できません")
+
+def _nbytes(v):
+    # DataFrame は文字列の中身まで数える。それ以外は pickle 後の大きさで近似
+    if isinstance(v, pd.DataFrame): return int(v.memory_usage(deep=True).sum())
+    if isinstance(v, pd.Series): return int(v.memory_usage(deep=True))
+    try: return len(pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception: return sys.getsizeof(v)
+
+def session_memory_report():
+    """このセッションの session_state をキーごとに大きい順で"""
+    rows = [(k, type(v).__name__, _nbytes(v)) for k, v in st.session_state.items()]
+    return pd.DataFrame(rows, columns=['key', 'type', 'bytes']).sort_values('bytes', ascending=False, ignore_index=True)
+
+def render_memory_report():
+    """セッションごとのメモリ使用量（共有の Trade_Log は全セッションで1つなので別枠）"""
+    st.markdown('<div class="section-title">メモリ使用量</div>', unsafe_allow_html=True)
+    report = session_memory_report()
+    shared = _tradelog_sync_state(store.key)['df'] if store else None
+    st.caption(f"このセッション: {report['bytes'].sum() / 1024:,.1f} KB　／　"
+               f"共有 Trade_Log（全セッションで1つ）: {_nbytes(shared) / 1024 ** 2 if shared is not None else 0:,.2f} MB")
+    st.dataframe(report.assign(KB=(report['bytes'] / 1024).round(1)).drop(columns='bytes').head(15),
+                 use_container_width=True, hide_index=True)
+
+with tab_settings:
+    st.markdown('<div class="section-title">接続情報</div>', unsafe_allow_html=True)
+    if get_backend() == 'sqlite':
+        st.code(f"TRADELOG_BACKEND: sqlite\nTRADELOG_DB_PATH: {os.path.abspath(get_db_path())}")
+        st.caption(f"SQLite: {'✅ OK' if store else '❌ 未接続'}")
+    elif get_sid():
+        st.code(f"SPREADSHEET_ID: {get_sid()}")
+        st.caption(f"Sheets接続: {'✅ OK' if store else '❌ 未接続'}")
+    else:
+        st.warning("SPREADSHEET_ID が未設定です。")
+        st.markdown("**必要な環境変数（Railway）:**\n- `GCP_SERVICE_ACCOUNT_JSON`\n- `SPREADSHEET_ID`\n\n"
+                    "ローカルの SQLite に保存する場合は `TRADELOG_BACKEND=sqlite`（保存先は `TRADELOG_DB_PATH`、既定 `tradelog.db`）")
+
+    st.markdown('<div class="section-title">データ操作</div>', unsafe_allow_html=True)
+    col_c1, col_c2 = st.columns(2)
+    with col_c1:
+        if st.button("🔄 キャッシュをクリア（全件読み直し）", use_container_width=True):
+            reload_tradelog(full=True); st.success("✅ クリアしました")
+    with col_c2:
+        if st.button("🗑 メモリをリセット", use_container_width=True):
+            for k in ['realized_df','history_df','pending','pending_rows','tag_state','positions']:
+                st.session_state.pop(k, None)
+            init_state(); st.success("✅ リセットしました")
+    if store:
+        if st.button("📦 保有状態をリセット（次回取込時に全履歴から再計算）", use_container_width=True):
+            save_position_state(store, empty_position_state(), None)
+            st.session_state['positions'] = None; st.success("✅ リセットしました")
+
+    if tab_open(tab_settings):
+        render_memory_report()
+        render_tradelog_view()
 
     st.divider()
     st.caption("TradeLog v2 — 爆速分析 × 高度なタグ付け")